@@ -0,0 +1,83 @@
+import os
+import sys
+import time
+import pickle
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+# Run from the repository root: python bin/benchmark_transport.py [rows]
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from core.SharedFrame import export_frame, import_frame, new_run_id, cleanup_run, release
+
+
+def make_frame(rows):
+    # Mostly fixed-width columns, the shape of a typical python node output
+    return pd.DataFrame({
+        'id': np.arange(rows, dtype=np.int64),
+        'height': np.random.randint(1, 200, rows),
+        'weight': np.random.rand(rows) * 1000,
+        'hp': np.random.randint(1, 255, rows).astype(np.int32),
+        'legendary': np.random.rand(rows) > 0.99,
+        'updated': pd.date_range('2024-01-01', periods=rows, freq='s'),
+    })
+
+
+def receiver(channel):
+    # Rebuild whatever arrives and report a checksum so the frame is really touched
+    while True:
+        kind, payload = channel.recv()
+        if kind == 'stop':
+            break
+        if kind == 'pickle':
+            df = pickle.loads(payload)
+        else:
+            df = import_frame(payload)
+        channel.send(int(df['id'].sum()))
+        if kind == 'shared':
+            del df
+            release(payload['segments'])
+
+
+def time_round_trips(channel, df, kind, repeat):
+    timings = []
+    for _ in range(repeat):
+        run_id = new_run_id()
+        start = time.perf_counter()
+        if kind == 'pickle':
+            payload = pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            payload = export_frame(df, run_id)
+        channel.send((kind, payload))
+        channel.recv()
+        timings.append(time.perf_counter() - start)
+        cleanup_run(run_id)
+    return min(timings)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repeat = 5
+    df = make_frame(rows)
+    size = df.memory_usage(deep=True).sum() / 1024 / 1024
+
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    process = context.Process(target=receiver, args=(child,))
+    process.start()
+    parent.send(('pickle', pickle.dumps(df.head(1))))
+    parent.recv()
+
+    pickled = time_round_trips(parent, df, 'pickle', repeat)
+    shared = time_round_trips(parent, df, 'shared', repeat)
+    parent.send(('stop', None))
+    process.join()
+
+    print(f"{rows} rows, {size:.1f} MB, best of {repeat}")
+    print(f"pickle over pipe:   {pickled * 1000:8.1f} ms")
+    print(f"shared memory:      {shared * 1000:8.1f} ms")
+    print(f"speedup:            {pickled / shared:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,115 +1,56 @@
 import os
+import sys
 import json
-import re
 import matplotlib.pyplot as plt
 import networkx as nx
-from jinja2 import Template
 
-# Custom XML parser function provided by you
-def xml(xml_string):
-    # Load variables.json from the root directory (one level up)
-    with open('../variables.json') as f:
-        variables = json.load(f)
-    
-    # Render the XML string using Jinja templating
-    template = Template(xml_string)
-    xml_string = template.render(variables)
-
-    # Regular expression patterns to match different elements
-    tag_pattern = re.compile(r'<(?P<tag>[a-z]+) (?P<attributes>[^>]+)>(?P<content>.*?)</\1>', re.DOTALL)
-    attr_pattern = re.compile(r'(?P<key>[a-z_]+)="(?P<value>[^"]*)"')
-
-    elements_list = []
-
-    # Find all tags with their attributes and content
-    for match in tag_pattern.finditer(xml_string):
-        tag_dict = {}
-        # Extract the tag name, attributes, and inner content
-        tag = match.group('tag')
-        attributes = match.group('attributes')
-        content = match.group('content').strip()
-
-        # Parse attributes
-        for attr_match in attr_pattern.finditer(attributes):
-            key = attr_match.group('key')
-            value = attr_match.group('value')
-            tag_dict[key] = value
-
-        # Add the content as 'code'
-        tag_dict['code'] = content
-
-        # Add the tag name as 'type'
-        tag_dict['type'] = tag
-
-        # Append the tag dictionary to the list
-        elements_list.append(tag_dict)
-
-    return elements_list
-
-# Parser to read XML file and apply the custom xml function
-def parser(xml_file_path):
-    # Open and read the file content into a string
-    with open(xml_file_path, 'r') as file:
-        xml_string = file.read()
-
-    # Parse the XML string using the custom XML function
-    elements_list = xml(xml_string)
-
-    # Output the result
-    return elements_list
+# Run from the repository root so pipeline paths and variables.json resolve as they do for a run
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+from core.Workspace import Workspace
 
 # Function to create a graph traversal order and output as graph.json and graph.png
-def create_pipeline_json_and_graph(pipelines_folder='../pipelines/'):
+def create_pipeline_json_and_graph(pipelines_pattern='pipelines/*.xml'):
+    workspace = Workspace.load(pipelines_pattern)
+    for path, error in workspace.errors.items():
+        print(f"Error parsing file {path}: {error}")
+
+    # Components that write the same table from different files
+    duplicates = {}
+    for target, keys in workspace.duplicates().items():
+        for key in keys:
+            duplicates[key] = [k for k in keys if k != key]
+        print(f"Warning: \"{target[3]}\".\"{target[4]}\" is written by {', '.join(keys)}")
+
+    # Node ids are namespaced by file (e.g. kanto:kanto_core), ids repeat across files
     graph_data = {}
-
-    # Iterate through all .xml files in the pipelines directory
-    for filename in os.listdir(pipelines_folder):
-        if filename.endswith(".xml"):
-            file_path = os.path.join(pipelines_folder, filename)
-            print(f"Parsing file: {file_path}")  # Debug output
-
-            # Use the custom parser function instead of xml.etree.ElementTree
-            try:
-                elements = parser(file_path)
-
-                # Traverse each parsed element and collect input-output relationships
-                for element in elements:
-                    elem_id = element.get('id')
-                    elem_type = element.get('type')
-
-                    # Only focus on python and sql components for the graph model
-                    if elem_type in ['python', 'sql']:
-                        graph_data[elem_id] = {
-                            'type': elem_type,
-                            'inputs': element.get('inputs', '').split(",") if element.get('inputs') else [],
-                            'outputs': [],  # To be filled when traversing other elements
-                            'chains_to': None  # Check if it chains to another pipeline
-                        }
-
-                        # Check for pipeline chaining (e.g., in Python code)
-                        if elem_type == 'python' and 'Pipeline(' in element['code']:
-                            chain_match = re.search(r'Pipeline\([\'"](.*?\.xml)[\'"]\)', element['code'])
-                            if chain_match:
-                                graph_data[elem_id]['chains_to'] = chain_match.group(1)
-
-            except Exception as e:
-                print(f"Error parsing file {file_path}: {e}")
-                continue  # Skip to the next file if parsing fails
-
-    # Now that we have collected all elements, let's build output dependencies
-    for elem_id, elem_data in graph_data.items():
-        for input_id in elem_data['inputs']:
-            if input_id and input_id in graph_data:
-                graph_data[input_id]['outputs'].append(elem_id)
+    downstream = workspace.downstream()
+    for key, table in workspace.nodes.items():
+        graph_data[key] = {
+            'type': table.type,
+            'pipeline': key.split(':')[0],
+            'id': table.id,
+            'writes': f"{table.schema}.{table.table}" if table.target() is not None else None,
+            'inputs': sorted(workspace.graph[key]),
+            'outputs': downstream[key],
+            # Pipelines this file runs as part of its own through <pipeline ref>
+            'chains_to': None,
+            'duplicate_writers': duplicates.get(key, []),
+        }
+    for name, pipeline in workspace.pipelines.items():
+        for table in pipeline.tables:
+            chains_to = sorted(set(pipeline.pipelines[i.split('.')[0]].file_name for i in table.inputs if i.split('.')[0] in pipeline.pipelines))
+            graph_data[f"{name}:{table.id}"]['chains_to'] = chains_to or None
 
     # Write the graph data to a JSON file
-    with open('../graph.json', 'w') as json_file:
+    with open('graph.json', 'w') as json_file:
         json.dump(graph_data, json_file, indent=4)
 
     print("graph.json created successfully!")
 
     # Now generate the graph image and save as graph.png
-    generate_pipeline_graph(graph_data, '../graph.png')
+    generate_pipeline_graph(graph_data, 'graph.png')
     print("graph.png created successfully!")
 
 def generate_pipeline_graph(data, output_filename):
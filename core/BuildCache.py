@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Local state kept next to the pipelines (build fingerprints, compiled plans, ...)
+CACHE_DIR = '.pipeline_cache'
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class BuildCache:
+    # Fingerprints of the last successful build of every node of one pipeline file.
+    # A node whose fingerprint (code, attributes and input versions) matches its
+    # last successful build can be skipped.
+    # Runs of the same file at the same time (e.g. on its own and referenced by
+    # another pipeline) share the file, every write merges into what is on disk.
+    file_lock = threading.Lock()
+
+    def __init__(self, name, directory=None):
+        directory = directory if directory else os.path.join(CACHE_DIR, 'builds')
+        self.path = os.path.join(directory, f"{name}.json")
+        self.lock = threading.Lock()
+        self.entries = self.read()
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def fresh(self, key, fingerprint):
+        entry = self.get(key)
+        return entry is not None and entry['fingerprint'] == fingerprint
+
+    def record(self, key, fingerprint, version):
+        with self.lock, BuildCache.file_lock:
+            self.entries = self.read()
+            self.entries[key] = {'fingerprint': fingerprint, 'version': version, 'built_at': time.time()}
+            self.save()
+
+    def forget(self, key):
+        with self.lock, BuildCache.file_lock:
+            self.entries = self.read()
+            if self.entries.pop(key, None) is not None:
+                self.save()
+
+    def save(self):
+        # Write to a temporary file first so a crash never leaves half a cache behind
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(temp_path, self.path)
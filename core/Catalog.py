@@ -0,0 +1,136 @@
+import threading
+
+# Schemas, tables, columns and primary keys of a set of schemas in one round trip.
+# Column types are normalized the same way as Connection.table_columns.
+CATALOG_QUERY = r"""
+    SELECT n.nspname, c.relname, a.attname, format_type(a.atttypid, NULL),
+        coalesce(substring(format_type(a.atttypid, a.atttypmod) from '\(.*\)'), ''),
+        (SELECT array_agg(pa.attname::text ORDER BY k.ord)
+            FROM pg_constraint con
+            CROSS JOIN unnest(con.conkey) WITH ORDINALITY AS k(attnum, ord)
+            JOIN pg_attribute pa ON pa.attrelid = con.conrelid AND pa.attnum = k.attnum
+            WHERE con.conrelid = c.oid AND con.contype = 'p')
+    FROM pg_namespace n
+    LEFT JOIN pg_class c ON c.relnamespace = n.oid AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+    LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    WHERE n.nspname = ANY(%s)
+    ORDER BY n.nspname, c.relname, a.attnum
+"""
+
+TYPES_QUERY = "SELECT oid, format_type(oid, NULL) FROM pg_type"
+
+
+def base_type(dtype):
+    # 'numeric(8,2)' -> 'numeric'
+    return dtype.split('(')[0]
+
+
+class Catalog:
+    # Metadata of the schemas the engine writes to, shared by every Connection on
+    # the same pool. While at least one run is active, lookups are answered from
+    # memory and the engine's own DDL keeps the entries current. Outside a run
+    # every lookup reads the database again.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.runs = set()
+        # schema -> {table: {'columns': {name: type}, 'primary_key': [names] or None}}
+        self.schemas = {}
+        # type oid -> format_type() name, for describing query results
+        self.types = {}
+
+    @property
+    def active(self):
+        return len(self.runs) > 0
+
+    def begin(self, run_id):
+        with self.lock:
+            self.runs.add(run_id)
+
+    def end(self, run_id):
+        with self.lock:
+            self.runs.discard(run_id)
+            if not self.active:
+                self.schemas = {}
+
+    def switch(self, run_id):
+        # For processes that serve one run at a time, e.g. a python worker
+        with self.lock:
+            if run_id not in self.runs:
+                self.runs = set()
+                self.schemas = {}
+            if run_id is not None:
+                self.runs.add(run_id)
+
+    def clear(self):
+        with self.lock:
+            self.schemas = {}
+
+    def load(self, cursor, schemas):
+        # Read every schema not cached yet with a single query
+        with self.lock:
+            missing = sorted(set(schemas) - set(self.schemas)) if self.active else sorted(set(schemas))
+            if len(missing) == 0:
+                return
+            cursor.execute(CATALOG_QUERY, (missing,))
+            loaded = {schema: None for schema in missing}
+            for schema, table, column, base, modifier, primary_key in cursor.fetchall():
+                if loaded[schema] is None:
+                    loaded[schema] = {}
+                if table is None:
+                    continue
+                entry = loaded[schema].setdefault(table, {'columns': {}, 'primary_key': primary_key})
+                if column is not None:
+                    entry['columns'][column] = base + modifier
+            # None marks a schema that does not exist
+            if self.active:
+                self.schemas.update(loaded)
+            return loaded
+
+    def lookup(self, cursor, schema):
+        with self.lock:
+            if self.active and schema in self.schemas:
+                return self.schemas[schema]
+            return self.load(cursor, [schema])[schema]
+
+    def schema_exists(self, cursor, schema):
+        return self.lookup(cursor, schema) is not None
+
+    def table(self, cursor, schema, table):
+        with self.lock:
+            tables = self.lookup(cursor, schema)
+            return None if tables is None else tables.get(table)
+
+    def type_name(self, cursor, oid):
+        with self.lock:
+            if oid not in self.types:
+                cursor.execute(TYPES_QUERY)
+                self.types = dict(cursor.fetchall())
+            return self.types.get(oid, str(oid))
+
+    def add_schema(self, schema):
+        with self.lock:
+            if self.active and self.schemas.get(schema) is None:
+                self.schemas[schema] = {}
+
+    def put_table(self, schema, table, columns, primary_key=None):
+        with self.lock:
+            if self.active and self.schemas.get(schema) is not None:
+                self.schemas[schema][table] = {'columns': dict(columns), 'primary_key': primary_key}
+
+    def add_columns(self, schema, table, columns):
+        with self.lock:
+            entry = self.schemas.get(schema, None) and self.schemas[schema].get(table)
+            if entry is not None:
+                entry['columns'].update(columns)
+
+    def set_primary_key(self, schema, table, primary_key):
+        with self.lock:
+            entry = self.schemas.get(schema, None) and self.schemas[schema].get(table)
+            if entry is not None:
+                entry['primary_key'] = primary_key
+
+    def forget(self, schema):
+        # The schema is read again on its next lookup, after DDL whose result is not
+        # known here (CREATE TABLE AS, renames) or a failed transaction
+        with self.lock:
+            self.schemas.pop(schema, None)
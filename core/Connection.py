@@ -1,20 +1,164 @@
+import io
+import itertools
+import json
+import math
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-from psycopg2 import sql, extras
+from psycopg2 import sql
 import pandas as pd
-from psycopg2.extensions import register_type, UNICODE, UNICODEARRAY
+from core.Catalog import base_type
+from core.ConnectionPool import ConnectionPool
+from core.Plan import WATERMARK_PLACEHOLDER
+
+# Rows serialized per COPY round so memory stays bounded for large frames
+COPY_CHUNK_ROWS = 100000
+# Smallest shard worth its own connection in a parallel write
+PARALLEL_MIN_ROWS = 10000
+# Rows fetched per round trip when reading through a server-side cursor
+STREAM_CHUNK_ROWS = 50000
+# Statements that can be read through a server-side cursor
+STREAMABLE_QUERY = re.compile(r'^\s*\(?\s*(SELECT|WITH|VALUES|TABLE)\b', re.IGNORECASE)
+# Column types for DataFrame columns, spelled the way format_type() reports them so
+# they compare equal to the catalog. Anything not recognised is stored as text.
+SIGNED_INTEGER_TYPES = {1: 'smallint', 2: 'smallint', 4: 'integer', 8: 'bigint'}
+UNSIGNED_INTEGER_TYPES = {1: 'smallint', 2: 'integer', 4: 'bigint', 8: 'numeric'}
+OBJECT_TYPES = {
+    'string': 'text',
+    'boolean': 'boolean',
+    'integer': 'bigint',
+    'floating': 'double precision',
+    'mixed-integer-float': 'double precision',
+    'decimal': 'numeric',
+    'date': 'date',
+    'timedelta': 'interval',
+}
+
+
+def postgres_type(series):
+    # Postgres type for a DataFrame column, inferred from its dtype or, for object
+    # columns, from the values it holds
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'boolean'
+    if pd.api.types.is_integer_dtype(dtype):
+        if pd.api.types.is_unsigned_integer_dtype(dtype):
+            return UNSIGNED_INTEGER_TYPES.get(dtype.itemsize, 'numeric')
+        return SIGNED_INTEGER_TYPES.get(dtype.itemsize, 'bigint')
+    if pd.api.types.is_float_dtype(dtype):
+        return 'real' if dtype.itemsize <= 4 else 'double precision'
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        return 'timestamp with time zone'
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return 'timestamp without time zone'
+    if pd.api.types.is_timedelta64_dtype(dtype):
+        return 'interval'
+    if isinstance(dtype, pd.CategoricalDtype):
+        return postgres_type(pd.Series(dtype.categories))
+    if not pd.api.types.is_object_dtype(dtype):
+        return 'text'
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind in OBJECT_TYPES:
+        return OBJECT_TYPES[kind]
+    if kind in ('datetime', 'datetime64'):
+        first = series.dropna().iloc[0]
+        return 'timestamp with time zone' if getattr(first, 'tzinfo', None) is not None else 'timestamp without time zone'
+    values = series.dropna()
+    if len(values) > 0 and values.map(lambda v: isinstance(v, (dict, list))).all():
+        return 'jsonb'
+    return 'text'
+
+
+# Types without an equality operator, compared as text when skipping unchanged rows
+NO_EQUALITY_TYPES = {'json', 'xml', 'point', 'line', 'lseg', 'box', 'path', 'polygon', 'circle'}
+
+
+def render_watermark(code, value):
+    # Fill in {{ this_watermark }}: the quoted high-water mark, or NULL on a full load
+    literal = "NULL" if value is None else "'" + str(value).replace("'", "''") + "'"
+    return code.replace(WATERMARK_PLACEHOLDER, literal)
+
+
+def json_value(value):
+    return json.dumps(value, default=str) if isinstance(value, (dict, list)) else value
+
 
 class Connection:
-    def __init__(self, id, host, port, username, password, database):
+    _schema_lock = threading.Lock()
+
+    def __init__(self, id, host, port, username, password, database, max_concurrency=None, pool_min_size=None, pool_max_size=None, pool_idle_timeout=None):
         self.id = id
         self.host = host
         self.port = port
         self.username = username
         self.password = password
-        self.session = None
-        self.conn = None
         self.database = database
+        self.max_concurrency = int(max_concurrency) if max_concurrency else None
+        self.pool_options = {
+            'min_size': int(pool_min_size) if pool_min_size else 1,
+            'max_size': int(pool_max_size) if pool_max_size else 10,
+            'idle_timeout': float(pool_idle_timeout) if pool_idle_timeout else 300,
+        }
+        # Sessions are per thread so the executor can build tables in parallel
+        self._local = threading.local()
 
-    def Session(self):
+    def config(self):
+        # Constructor arguments, used to rebuild this connection inside a worker process
+        return {
+            'id': self.id,
+            'host': self.host,
+            'port': self.port,
+            'username': self.username,
+            'password': self.password,
+            'database': self.database,
+            'pool_min_size': self.pool_options['min_size'],
+            'pool_max_size': self.pool_options['max_size'],
+            'pool_idle_timeout': self.pool_options['idle_timeout'],
+        }
+
+    @property
+    def session(self):
+        return getattr(self._local, 'session', None)
+
+    @session.setter
+    def session(self, value):
+        self._local.session = value
+
+    @property
+    def conn(self):
+        return getattr(self._local, 'conn', None)
+
+    @conn.setter
+    def conn(self, value):
+        self._local.conn = value
+
+    @property
+    def grouped(self):
+        # True while this thread's statements belong to a transaction group
+        return getattr(self._local, 'grouped', False)
+
+    def begin_group(self):
+        # Later commits on this thread are deferred to end_group
+        if not self.session:
+            self.Session()
+        self._local.grouped = True
+
+    def end_group(self, commit=True):
+        self._local.grouped = False
+        if self.conn is not None:
+            if commit:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+
+    def commit(self):
+        if not self.grouped:
+            self.conn.commit()
+
+    @property
+    def pool(self):
         db_config = {
             'user': self.username,
             'password': self.password,
@@ -22,12 +166,57 @@ class Connection:
             'port': self.port,
             'database': self.database
         }
-        self.conn = psycopg2.connect(**db_config)
+        key = (self.id, self.host, str(self.port), self.username, self.database)
+        return ConnectionPool.shared(key, db_config, **self.pool_options)
+
+    @property
+    def catalog(self):
+        return self.pool.catalog
+
+    def Session(self):
+        # Reuse the connection this thread already holds, otherwise borrow one from the pool
+        if self.conn is not None and self.conn.closed:
+            self.pool.release(self.conn)
+            self.conn = None
+        if self.conn is None:
+            self.conn = self.pool.acquire()
+        if self.session:
+            self.session.close()
         self.session = self.conn.cursor()
 
     def close(self):
         if self.session:
             self.session.close()
+            self.session = None
+        if self.conn is not None:
+            self.pool.release(self.conn)
+            self.conn = None
+
+    def create_schema(self, schema):
+        # Nothing to do for a schema the run's catalog already knows
+        if self.catalog.active and self.catalog.schema_exists(self.session, schema):
+            return
+        # Concurrent CREATE SCHEMA IF NOT EXISTS can still collide on the catalog
+        # index, so parallel builds take turns and commit the schema right away.
+        # A grouped transaction must not be committed early, it uses a connection of its own.
+        with Connection._schema_lock:
+            create_schema_query = sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(
+                sql.Identifier(schema)
+            )
+            conn = self.pool.acquire() if self.grouped else self.conn
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute(create_schema_query)
+                conn.commit()
+            finally:
+                if self.grouped:
+                    self.pool.release(conn)
+            self.catalog.add_schema(schema)
+
+    def send(self, statements):
+        # Several statements in a single round trip
+        if len(statements) > 0:
+            self.session.execute(sql.SQL(';\n').join(statements))
 
     def query(self, code):
         if not self.session:
@@ -36,65 +225,420 @@ class Connection:
         result = self.session
         return result
 
-    def query_to_df(self, code):
+    def table_status(self, tables):
+        # Existence and freshness of many tables in a single catalog round trip.
+        # Returns {(schema, table): None} for missing tables, otherwise the
+        # live row estimate and write counters from pg_stat_all_tables.
+        tables = list(tables)
+        if len(tables) == 0:
+            return {}
         if not self.session:
             self.Session()
-        self.session.execute(sql.SQL(code))
-        result = self.session.fetchall()
-        col_names = [desc[0] for desc in self.session.description]
-
-        # Create a DataFrame from the result
-        df = pd.DataFrame(result, columns=col_names)
-        return df
-
-    def df_to_table(self, df, table, database, schema, materialization_type, schema_change_behavior='drop_and_recreate', primary_key=None):
-        table_name = f"{schema}.{table}"
+        status_query = sql.SQL("""
+            SELECT t.schema_name, t.table_name, c.oid IS NOT NULL,
+                s.n_live_tup, s.n_tup_ins, s.n_tup_upd, s.n_tup_del,
+                GREATEST(s.last_vacuum, s.last_autovacuum, s.last_analyze, s.last_autoanalyze)
+            FROM unnest(%s::text[], %s::text[]) AS t(schema_name, table_name)
+            LEFT JOIN pg_namespace n ON n.nspname = t.schema_name
+            LEFT JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = t.table_name
+                AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+            LEFT JOIN pg_stat_all_tables s ON s.relid = c.oid
+        """)
+        self.session.execute(status_query, ([t[0] for t in tables], [t[1] for t in tables]))
+        status = {}
+        for schema, table, exists, live, inserted, updated, deleted, maintained in self.session.fetchall():
+            status[(schema, table)] = {
+                'rows': live,
+                'inserted': inserted,
+                'updated': updated,
+                'deleted': deleted,
+                'last_maintained': maintained,
+            } if exists else None
+        return status
+
+    def projection(self, code, columns=None):
+        if not columns:
+            return sql.SQL(code)
+        return sql.SQL("SELECT {} FROM ({}) AS subquery").format(
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            sql.SQL(code)
+        )
 
+    def iter_frames(self, conn, code, chunk_size=STREAM_CHUNK_ROWS, chunk_bytes=None, columns=None):
+        # A named cursor keeps the result on the server, only one chunk is ever held client side
+        cursor = conn.cursor(name=f"pipeline_stream_{uuid.uuid4().hex}")
+        try:
+            cursor.execute(self.projection(code, columns))
+            rows_per_chunk = chunk_size
+            emitted = False
+            while True:
+                batch = cursor.fetchmany(rows_per_chunk)
+                col_names = [desc[0] for desc in cursor.description]
+                if not batch:
+                    if not emitted:
+                        yield pd.DataFrame([], columns=col_names)
+                    break
+                df = pd.DataFrame(batch, columns=col_names)
+                del batch
+                if chunk_bytes:
+                    # Resize later chunks from the observed width of a row
+                    row_bytes = max(1, df.memory_usage(deep=True).sum() / len(df))
+                    rows_per_chunk = max(1, int(chunk_bytes // row_bytes))
+                emitted = True
+                yield df
+        finally:
+            cursor.close()
+
+    def stream_query(self, code, chunk_size=STREAM_CHUNK_ROWS, chunk_bytes=None, columns=None):
+        # Streams run on their own pooled connection so they can be consumed lazily
+        conn = self.pool.acquire()
+        try:
+            yield from self.iter_frames(conn, code, chunk_size, chunk_bytes, columns)
+        finally:
+            self.pool.release(conn)
+
+    def query_to_df(self, code, chunksize=None, columns=None):
+        if chunksize:
+            return self.stream_query(code, chunk_size=int(chunksize), columns=columns)
         if not self.session:
             self.Session()
+        if not STREAMABLE_QUERY.match(code):
+            self.session.execute(sql.SQL(code))
+            result = self.session.fetchall()
+            col_names = [desc[0] for desc in self.session.description]
 
-        # Get column names and data from DataFrame
-        columns = df.columns.tolist()
-        data = df.values.tolist()
+            # Create a DataFrame from the result
+            df = pd.DataFrame(result, columns=col_names)
+            return df
+        frames = list(self.iter_frames(self.conn, code, columns=columns))
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+
+    def ensure_primary_key(self, schema, table, primary_key):
+        # Check if primary key already exists in the table
+        entry = self.catalog.table(self.session, schema, table)
+        primary_key_exists = entry is not None and bool(entry['primary_key'])
+
+        # Add primary key if it doesn't exist
+        if not primary_key_exists:
+            try:
+                create_primary = sql.SQL("ALTER TABLE {}.{} ADD PRIMARY KEY ({});").format(
+                    sql.Identifier(schema),
+                    sql.Identifier(table),
+                    sql.Identifier(primary_key),
+                )
+                self.session.execute(create_primary)
+                self.catalog.set_primary_key(schema, table, [primary_key])
+            except psycopg2.Error as e:
+                # Ignore if the primary key already exists
+                if "already exists" not in str(e):
+                    raise e
+
+    def changed_condition(self, schema, table, columns):
+        # WHERE clause for ON CONFLICT DO UPDATE that leaves identical rows untouched,
+        # so re-sent rows cost no new row version, WAL or index writes
+        types = self.table_columns(schema, table)
+        def column(prefix, col):
+            value = sql.SQL('{}.{}').format(sql.SQL(prefix), sql.Identifier(col))
+            if types.get(col, '').split('(')[0] in NO_EQUALITY_TYPES:
+                return sql.SQL('{}::text').format(value)
+            return value
+        return sql.SQL("WHERE ({}) IS DISTINCT FROM ({})").format(
+            sql.SQL(', ').join(column('target', col) for col in columns),
+            sql.SQL(', ').join(column('EXCLUDED', col) for col in columns)
+        )
 
-        # Create schema if it does not exist
-        create_schema_query = sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(
-            sql.Identifier(schema)
+    def upsert_query(self, schema, table, stage, columns, primary_key):
+        # Move a staged frame into the table, updating the rows whose key already exists
+        return sql.SQL("""
+            INSERT INTO {}.{} AS target ({})
+            SELECT {} FROM {}
+            ON CONFLICT ({}) DO UPDATE 
+            SET {}
+            {}
+        """).format(
+            sql.Identifier(schema),
+            sql.Identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            stage,
+            sql.Identifier(primary_key),
+            sql.SQL(', ').join(
+                sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col)) for col in columns if col != primary_key
+            ),
+            self.changed_condition(schema, table, [col for col in columns if col != primary_key])
         )
-        self.session.execute(create_schema_query)
 
-        # Check if table exists
-        table_exists_query = sql.SQL("""
+    def high_water_mark(self, schema, table, column):
+        # Largest watermark value already loaded, served by an index on the column
+        index_exists_query = sql.SQL("""
             SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_schema = %s AND table_name = %s
+                SELECT FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = i.indkey[0]
+                WHERE n.nspname = %s AND c.relname = %s AND a.attname = %s
             )
         """)
-        self.session.execute(table_exists_query, (schema, table))
-        table_exists = self.session.fetchone()[0]
+        self.session.execute(index_exists_query, (schema, table, column))
+        if not self.session.fetchone()[0]:
+            create_index_query = sql.SQL("CREATE INDEX {} ON {}.{} ({})").format(
+                sql.Identifier(f"{table}_{column}_watermark"[:63]),
+                sql.Identifier(schema),
+                sql.Identifier(table),
+                sql.Identifier(column)
+            )
+            self.session.execute(create_index_query)
+        high_water_mark_query = sql.SQL("SELECT max({})::text FROM {}.{}").format(
+            sql.Identifier(column),
+            sql.Identifier(schema),
+            sql.Identifier(table)
+        )
+        self.session.execute(high_water_mark_query)
+        return self.session.fetchone()[0]
+
+    def swap_table(self, schema, table, build, schema_change_behavior='drop_and_recreate', primary_key=None):
+        # Build the new version next to the live table, then rename it into place.
+        # Readers keep the old version until the final renames, which only hold
+        # the exclusive lock for the few statements before the commit.
+        shadow = f"{table}__shadow"[:63]
+        previous = f"{table}__previous"[:63]
+        target = sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(shadow))
+
+        self.session.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(target))
+        build(target)
+        # The shadow table is new to the catalog
+        self.catalog.forget(schema)
+
+        live_columns = self.table_columns(schema, table)
+        if live_columns and schema_change_behavior == 'error' and live_columns != self.table_columns(schema, shadow):
+            raise ValueError(f"Schema mismatch detected between the new and existing table {schema}.{table}. Aborting.")
+        if live_columns:
+            self.copy_indexes(schema, table, shadow)
+            self.catalog.forget(schema)
+        if primary_key is not None:
+            self.ensure_primary_key(schema, shadow, primary_key)
+        self.session.execute(sql.SQL("ANALYZE {}").format(target))
+
+        self.session.execute(sql.SQL("DROP TABLE IF EXISTS {}.{}").format(sql.Identifier(schema), sql.Identifier(previous)))
+        if live_columns:
+            # The replaced version is kept for rollback_swap until the next swap
+            self.session.execute(sql.SQL("ALTER TABLE {}.{} RENAME TO {}").format(
+                sql.Identifier(schema), sql.Identifier(table), sql.Identifier(previous)))
+        self.session.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(target, sql.Identifier(table)))
+        self.commit()
+        self.catalog.forget(schema)
+
+    def copy_indexes(self, schema, table, shadow):
+        # Recreate the live table's primary key, unique constraints and indexes on the
+        # shadow table. Anything that no longer fits the new columns is dropped.
+        definitions_query = sql.SQL("""
+            SELECT 'constraint', pg_get_constraintdef(con.oid)
+            FROM pg_constraint con
+            JOIN pg_class c ON c.oid = con.conrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relname = %s AND con.contype IN ('p', 'u')
+            UNION ALL
+            SELECT 'index', pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relname = %s
+            AND NOT EXISTS (SELECT FROM pg_constraint con WHERE con.conindid = i.indexrelid)
+        """)
+        self.session.execute(definitions_query, (schema, table, schema, table))
+        target = sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(shadow))
+        for kind, definition in self.session.fetchall():
+            if kind == 'constraint':
+                statement = sql.SQL("ALTER TABLE {} ADD {}").format(target, sql.SQL(definition))
+            else:
+                # Let Postgres name the index, the live table's names are taken
+                match = re.match(r'CREATE (UNIQUE )?INDEX \S+ ON (?:ONLY )?\S+ (USING .*)$', definition, re.DOTALL)
+                if not match:
+                    continue
+                statement = sql.SQL("CREATE {}INDEX ON {} {}").format(
+                    sql.SQL(match.group(1) or ''), target, sql.SQL(match.group(2)))
+            self.session.execute("SAVEPOINT copy_index")
+            try:
+                self.session.execute(statement)
+                self.session.execute("RELEASE SAVEPOINT copy_index")
+            except psycopg2.Error as e:
+                self.session.execute("ROLLBACK TO SAVEPOINT copy_index")
+                print(f"Not copied to the new {schema}.{table}: {definition} ({str(e).strip()})")
+
+    def rollback_swap(self, schema, table):
+        # Exchange the live table with the version it replaced
+        previous = f"{table}__previous"[:63]
+        if not self.session:
+            self.Session()
+        self.catalog.forget(schema)
+        if not self.table_columns(schema, previous):
+            raise ValueError(f"No previous version of {schema}.{table} to roll back to")
+        parked = f"{table}__rollback"[:63]
+        for old, new in ((table, parked), (previous, table), (parked, previous)):
+            self.session.execute(sql.SQL("ALTER TABLE {}.{} RENAME TO {}").format(
+                sql.Identifier(schema), sql.Identifier(old), sql.Identifier(new)))
+        self.conn.commit()
+        self.catalog.forget(schema)
+        print(f"Rolled {schema}.{table} back to its previous version.")
+
+    def copy_df(self, df, target, columns, chunk_size=COPY_CHUNK_ROWS, converters=None):
+        # Stream the frame to the server with COPY, a bounded slice of rows at a time
+        copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+            target,
+            sql.SQL(', ').join(map(sql.Identifier, columns))
+        ).as_string(self.conn)
+        for start in range(0, len(df), chunk_size):
+            buffer = io.StringIO()
+            chunk = df.iloc[start:start + chunk_size]
+            if converters:
+                chunk = chunk.copy(deep=False)
+                for col, converter in converters.items():
+                    chunk[col] = chunk[col].map(converter)
+            chunk.to_csv(buffer, header=False, index=False, na_rep='\\N')
+            buffer.seek(0)
+            self.session.copy_expert(copy_query, buffer)
+
+    def table_columns(self, schema, table):
+        # {column: normalized type} of an existing table in column order, {} if it does not exist
+        entry = self.catalog.table(self.session, schema, table)
+        return dict(entry['columns']) if entry is not None else {}
+
+    def normalize_types(self, types):
+        # Canonical spelling of user supplied type names, e.g. int -> integer or
+        # varchar(20) -> character varying(20), so they compare equal to the catalog
+        if len(types) == 0:
+            return {}
+        normalize_query = sql.SQL(r"""
+            SELECT t.name, format_type(to_regtype(t.type), NULL),
+                coalesce(regexp_replace(substring(t.type from '\(.*\)'), '\s', '', 'g'), '')
+            FROM unnest(%s::text[], %s::text[]) AS t(name, type)
+        """)
+        self.session.execute(normalize_query, (list(types.keys()), list(types.values())))
+        normalized = {}
+        for col, base, modifier in self.session.fetchall():
+            if base is None:
+                raise ValueError(f"Unknown column type '{types[col]}' for column '{col}'")
+            normalized[col] = base + modifier
+        return normalized
+
+    def column_types(self, df, overrides=None):
+        # Declared and normalized Postgres types of every DataFrame column.
+        # Declared types come from the dtypes unless the component overrides them.
+        overrides = {col: dtype for col, dtype in (overrides or {}).items() if col in df.columns}
+        declared = {}
+        for position, col in enumerate(df.columns):
+            declared[col] = overrides[col] if col in overrides else postgres_type(df.iloc[:, position])
+        normalized = {col: dtype for col, dtype in declared.items() if col not in overrides}
+        normalized.update(self.normalize_types(overrides))
+        return declared, {col: normalized[col] for col in declared}
+
+    def column_definitions(self, types):
+        return sql.SQL(', ').join(
+            sql.SQL('{} {}').format(sql.Identifier(col), sql.SQL(dtype)) for col, dtype in types.items()
+        )
 
-        # If table exists, check schema
-        if table_exists:
-            # Retrieve the current table schema
-            get_table_schema_query = sql.SQL("""
-                SELECT column_name, data_type 
-                FROM information_schema.columns 
-                WHERE table_schema = %s AND table_name = %s
-            """)
-            self.session.execute(get_table_schema_query, (schema, table))
-            existing_schema = self.session.fetchall()
+    def copy_shard(self, df, target, columns, chunk_size=COPY_CHUNK_ROWS, converters=None):
+        # Runs on a writer thread, which borrows its own pooled connection
+        self.Session()
+        try:
+            self.copy_df(df, target, columns, chunk_size, converters)
+            self.conn.commit()
+        finally:
+            self.close()
+
+    def parallel_stage(self, df, schema, table, declared_types, chunk_size=COPY_CHUNK_ROWS, converters=None, parallelism=None):
+        # COPY row ranges of the frame at the same time over several pooled connections
+        # into one unlogged staging table. Returns the staging table, or None when the
+        # frame is too small or the pool too narrow for more than one writer.
+        if not parallelism or len(df) == 0:
+            return None
+        # This thread keeps its own connection, the writers get the rest of the pool
+        workers = min(int(parallelism), self.pool_options['max_size'] - 1, math.ceil(len(df) / PARALLEL_MIN_ROWS))
+        if workers <= 1:
+            return None
+        staging = sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(f"{table}__staging"[:63]))
+        # Also clears what a failed earlier run left behind
+        self.session.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(staging))
+        self.session.execute(sql.SQL("CREATE UNLOGGED TABLE {} ({})").format(staging, self.column_definitions(declared_types)))
+        self.conn.commit()
 
-            # Convert existing schema into a dictionary for easier comparison
-            existing_schema_dict = {col: dtype for col, dtype in existing_schema}
+        columns = df.columns.tolist()
+        bounds = [round(len(df) * shard / workers) for shard in range(workers + 1)]
+        with ThreadPoolExecutor(max_workers=workers) as writers:
+            shards = [writers.submit(self.copy_shard, df.iloc[bounds[shard]:bounds[shard + 1]], staging, columns, chunk_size, converters)
+                for shard in range(workers)]
+        for shard in shards:
+            shard.result()
+        return staging
+
+    def df_to_table(self, df, table, database, schema, materialization_type, schema_change_behavior='drop_and_recreate', primary_key=None, chunk_size=COPY_CHUNK_ROWS, column_types=None, parallelism=None):
+        table_name = f"{schema}.{table}"
+
+        if not self.session:
+            self.Session()
 
-            # Assuming all DataFrame columns are TEXT by default (adjust as necessary)
-            df_schema_dict = {col: 'TEXT' for col in columns}
+        # Get column names from DataFrame
+        columns = df.columns.tolist()
+        declared_types, df_schema_dict = self.column_types(df, column_types)
+        # Lists and dicts are written as JSON so they load into jsonb columns
+        converters = {col: json_value for col, dtype in df_schema_dict.items() if dtype in ('json', 'jsonb')}
 
+        # Create schema if it does not exist
+        self.create_schema(schema)
+
+        # With parallelism the rows are loaded up front and the statements below read
+        # them from the staging table in one set-based statement
+        staging = self.parallel_stage(df, schema, table, declared_types, chunk_size, converters, parallelism) \
+            if materialization_type in ('incremental', 'truncate', 'temp', 'swap') else None
+
+        def load(target):
+            if staging is None:
+                self.copy_df(df, target, columns, chunk_size, converters)
+                return
+            self.session.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(
+                target,
+                sql.SQL(', ').join(map(sql.Identifier, columns)),
+                sql.SQL(', ').join(map(sql.Identifier, columns)),
+                staging
+            ))
+            self.session.execute(sql.SQL("DROP TABLE {}").format(staging))
+
+        if materialization_type == 'swap':
+            def build(target):
+                self.session.execute(sql.SQL("CREATE TABLE {} ({})").format(target, self.column_definitions(declared_types)))
+                load(target)
+            self.swap_table(schema, table, build, schema_change_behavior, primary_key)
+            print(f"DataFrame written to {table_name} successfully.")
+            return
+
+        # Current columns of the table, empty when it does not exist yet
+        existing_schema_dict = self.table_columns(schema, table)
+        table_exists = len(existing_schema_dict) > 0
+
+        # If table exists, check schema
+        if table_exists:
             # Check for schema differences
             schema_diff = df_schema_dict != existing_schema_dict
+            # New columns only, every existing column kept with its type
+            added_columns = [col for col in columns if col not in existing_schema_dict]
+            additive = schema_diff and all(df_schema_dict.get(col) == dtype for col, dtype in existing_schema_dict.items())
 
             if schema_diff:
-                if schema_change_behavior == 'drop_and_recreate':
+                if schema_change_behavior == 'drop_and_recreate' and additive:
+                    # Extend the table in place, existing rows get NULL in the new columns
+                    for col in added_columns:
+                        add_column_query = sql.SQL("ALTER TABLE {}.{} ADD COLUMN {} {}").format(
+                            sql.Identifier(schema),
+                            sql.Identifier(table),
+                            sql.Identifier(col),
+                            sql.SQL(declared_types[col])
+                        )
+                        self.session.execute(add_column_query)
+                    self.catalog.add_columns(schema, table, {col: df_schema_dict[col] for col in added_columns})
+
+                elif schema_change_behavior == 'drop_and_recreate':
                     # Drop and recreate the table
                     drop_table_query = sql.SQL("DROP TABLE IF EXISTS {}.{}").format(
                         sql.Identifier(schema),
@@ -106,11 +650,10 @@ class Connection:
                     create_table_query = sql.SQL("CREATE TABLE {}.{} ({})").format(
                         sql.Identifier(schema),
                         sql.Identifier(table),
-                        sql.SQL(', ').join(
-                            sql.SQL('{} {}').format(sql.Identifier(col), sql.SQL('TEXT')) for col in columns  # Assuming TEXT, modify this as needed
-                        )
+                        self.column_definitions(declared_types)
                     )
                     self.session.execute(create_table_query)
+                    self.catalog.put_table(schema, table, df_schema_dict)
 
                 elif schema_change_behavior == 'error':
                     raise ValueError(f"Schema mismatch detected between DataFrame and existing table {table_name}. Aborting.")
@@ -121,33 +664,33 @@ class Connection:
             create_table_query = sql.SQL("CREATE TABLE {}.{} ({})").format(
                 sql.Identifier(schema),
                 sql.Identifier(table),
-                sql.SQL(', ').join(
-                    sql.SQL('{} {}').format(sql.Identifier(col), sql.SQL('TEXT')) for col in columns  # Assuming TEXT, modify this as needed
-                )
+                self.column_definitions(declared_types)
             )
             self.session.execute(create_table_query)
+            self.catalog.put_table(schema, table, df_schema_dict)
 
         # Handle materialization_type logic
         if materialization_type == 'incremental':
             if primary_key is None:
                 raise ValueError("Primary key is required for incremental materialization.")
 
-            # Perform insert/update using primary_key
-            update_query = sql.SQL("""
-                INSERT INTO {}.{} ({}) 
-                VALUES %s
-                ON CONFLICT ({}) DO UPDATE 
-                SET {}
-            """).format(
-                sql.Identifier(schema),
-                sql.Identifier(table),
-                sql.SQL(', ').join(map(sql.Identifier, columns)),
-                sql.Identifier(primary_key),
-                sql.SQL(', ').join(
-                    sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col)) for col in columns if col != primary_key
+            self.ensure_primary_key(schema, table, primary_key)
+
+            # Stage the frame with COPY, then upsert it in one set-based statement
+            stage_table_name = f"stage_{table}"
+            stage = staging if staging is not None else sql.Identifier(stage_table_name)
+            if staging is None:
+                create_stage_query = sql.SQL("CREATE TEMP TABLE {} (LIKE {}.{} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+                    sql.Identifier(stage_table_name),
+                    sql.Identifier(schema),
+                    sql.Identifier(table)
                 )
-            )
-            extras.execute_values(self.session, update_query, data)
+                self.session.execute(create_stage_query)
+                self.copy_df(df, stage, columns, chunk_size, converters)
+
+            self.session.execute(self.upsert_query(schema, table, stage, columns, primary_key))
+            # Gone before the commit as well, a transaction may upsert several frames
+            self.session.execute(sql.SQL("DROP TABLE {}").format(stage))
 
         elif materialization_type == 'truncate':
             # Truncate and insert all data
@@ -156,82 +699,131 @@ class Connection:
                 sql.Identifier(table)
             )
             self.session.execute(truncate_query)
-
-            insert_query = sql.SQL('INSERT INTO {}.{} ({}) VALUES %s').format(
-                sql.Identifier(schema),
-                sql.Identifier(table),
-                sql.SQL(', ').join(map(sql.Identifier, columns))
-            )
-            extras.execute_values(self.session, insert_query, data)
+            load(sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(table)))
 
         elif materialization_type == 'temp':
             # Create temp table and insert all data
             temp_table_name = f"temp_{table}"
             create_temp_table_query = sql.SQL("CREATE TEMP TABLE {} ({})").format(
                 sql.Identifier(temp_table_name),
-                sql.SQL(', ').join(
-                    sql.SQL('{} {}').format(sql.Identifier(col), sql.SQL('TEXT')) for col in columns  # Assuming TEXT, modify this as needed
-                )
+                self.column_definitions(declared_types)
             )
             self.session.execute(create_temp_table_query)
-
-            insert_query = sql.SQL('INSERT INTO {} ({}) VALUES %s').format(
-                sql.Identifier(temp_table_name),
-                sql.SQL(', ').join(map(sql.Identifier, columns))
-            )
-            extras.execute_values(self.session, insert_query, data)
+            load(sql.Identifier(temp_table_name))
 
         elif materialization_type == 'None':
             # Simply return the DataFrame
             return df
 
-        # Commit the transaction
-        self.conn.commit()
+        # Commit the transaction, unless it is part of a group
+        self.commit()
 
         print(f"DataFrame written to {table_name} successfully.")
 
-    def query_to_table(self, query, table, database, schema, materialization_type, schema_change_behavior='drop_and_recreate', primary_key=None):
+    def frames_to_table(self, frames, table, database, schema, materialization_type, schema_change_behavior='drop_and_recreate', primary_key=None, column_types=None):
+        # Write a stream of frames as one version of a table, in one transaction. The
+        # first frame sets the table up like df_to_table and fixes the column types.
+        # The others are converted to those types and appended (or upserted, for
+        # incremental) as they arrive, so the schema never changes halfway through.
+        if not self.session:
+            self.Session()
+        frames = iter(frames)
+        rows = 0
+        self.begin_group()
+        try:
+            first = next(frames, None)
+            if first is not None and materialization_type == 'swap':
+                rows = self.swap_frames(itertools.chain([first], frames), table, schema, schema_change_behavior, primary_key, column_types)
+            elif first is not None:
+                rows = len(first)
+                self.df_to_table(first, table, database, schema, materialization_type, schema_change_behavior=schema_change_behavior,
+                    primary_key=primary_key, column_types=column_types)
+                types = self.column_types(first, column_types)[1]
+                target = sql.Identifier(f"temp_{table}") if materialization_type == 'temp' else \
+                    sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(table))
+                for df in frames:
+                    rows += len(df)
+                    if materialization_type == 'incremental':
+                        self.upsert_df(df, schema, table, primary_key, types)
+                    elif materialization_type != 'None':
+                        self.append_df(df, target, types)
+        except Exception:
+            self.end_group(commit=False)
+            raise
+        self.end_group(commit=True)
+        print(f"{rows} rows written to {schema}.{table} in one transaction.")
+
+    def swap_frames(self, frames, table, schema, schema_change_behavior='drop_and_recreate', primary_key=None, column_types=None):
+        # Every frame goes into the shadow table first, the live table is only locked
+        # for the renames at the very end. Returns the number of rows written.
+        rows = 0
+        def build(target):
+            nonlocal rows
+            types = None
+            for df in frames:
+                if types is None:
+                    declared_types, types = self.column_types(df, column_types)
+                    self.session.execute(sql.SQL("CREATE TABLE {} ({})").format(target, self.column_definitions(declared_types)))
+                self.append_df(df, target, types)
+                rows += len(df)
+        self.create_schema(schema)
+        self.swap_table(schema, table, build, schema_change_behavior, primary_key)
+        print(f"DataFrame written to {schema}.{table} successfully.")
+        return rows
+
+    def upsert_df(self, df, schema, table, primary_key, types, chunk_size=COPY_CHUNK_ROWS):
+        # Upsert one more frame into a table set up by df_to_table, converted to its types
+        stage = sql.Identifier(f"stage_{table}")
+        self.session.execute(sql.SQL("CREATE TEMP TABLE {} (LIKE {}.{} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+            stage, sql.Identifier(schema), sql.Identifier(table)))
+        self.append_df(df, stage, types, chunk_size)
+        self.session.execute(self.upsert_query(schema, table, stage, df.columns.tolist(), primary_key))
+        self.session.execute(sql.SQL("DROP TABLE {}").format(stage))
+
+    def append_df(self, df, target, types, chunk_size=COPY_CHUNK_ROWS):
+        # Add one more frame to a table set up by df_to_table. Values are converted to
+        # the table's types where this frame's inference differs, e.g. integer columns
+        # that came out as float because of missing values.
+        unknown = [col for col in df.columns if col not in types]
+        if unknown:
+            raise ValueError(f"Columns {', '.join(map(str, unknown))} were not in the first frame written to {target.as_string(self.conn)}")
+        df = df.copy(deep=False)
+        for col in df.columns:
+            if base_type(types[col]) in SIGNED_INTEGER_TYPES.values() and pd.api.types.is_float_dtype(df[col].dtype):
+                df[col] = df[col].astype('Int64')
+        converters = {col: json_value for col in df.columns if base_type(types[col]) in ('json', 'jsonb')}
+        self.copy_df(df, target, df.columns.tolist(), chunk_size, converters)
+
+    def query_to_table(self, query, table, database, schema, materialization_type, schema_change_behavior='drop_and_recreate', primary_key=None, watermark=None):
         table_name = f"{schema}.{table}"
+        # Everything but the incremental load itself sees the unfiltered query
+        query_template = query
+        query = render_watermark(query_template, None)
 
         if not self.session:
             self.Session()
 
         # Create schema if it does not exist
-        create_schema_query = sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(
-            sql.Identifier(schema)
-        )
-        self.session.execute(create_schema_query)
-
-        # Check if table exists
-        table_exists_query = sql.SQL("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_schema = %s AND table_name = %s
-            )
-        """)
-        self.session.execute(table_exists_query, (schema, table))
-        table_exists = self.session.fetchone()[0]
+        self.create_schema(schema)
+
+        if materialization_type == 'swap':
+            def build(target):
+                self.session.execute(sql.SQL("CREATE TABLE {} AS ({})").format(target, sql.SQL(query)))
+            self.swap_table(schema, table, build, schema_change_behavior, primary_key)
+            print(f"Query results written to {table_name} successfully.")
+            return
+
+        # Check if table exists, its columns come from the catalog
+        existing_schema_dict = {col: base_type(dtype) for col, dtype in self.table_columns(schema, table).items()}
+        table_exists = len(existing_schema_dict) > 0
         # If table exists, check schema
         query_schema_query = f"""SELECT * FROM ({query}) AS subquery LIMIT 0;"""
         self.session.execute(query_schema_query)
-        query_schema = [(desc[0], psycopg2.extensions.string_types[desc[1]].name) for desc in self.session.description]  # Get column names and 
+        query_schema = [(desc[0], self.catalog.type_name(self.session, desc[1])) for desc in self.session.description]  # Get column names and types
         query_schema_dict = {col: dtype for col, dtype in query_schema}
+        # DDL and the load go out together, nothing in between needs a result
+        statements = []
         if table_exists:
-            query_schema_query = f"""
-                SELECT * FROM "{schema}"."{table}" AS subquery LIMIT 0;
-            """
-            self.session.execute(query_schema_query)
-            existing_schema = [(desc[0], psycopg2.extensions.string_types[desc[1]].name) for desc in self.session.description]  # Get column names and data types
-
-            # query_schema_query = f"""
-                # SELECT * FROM ({query}) AS subquery LIMIT 0;
-            # """
-            # print(query_schema_query)
-            # self.session.execute(query_schema_query)
-            # query_schema = [(desc[0], psycopg2.extensions.string_types[desc[1]].name) for desc in self.session.description]  # Get column names and data types
-
-            existing_schema_dict = {col: dtype for col, dtype in existing_schema}
-            # query_schema_dict = {col: dtype for col, dtype in query_schema}
             schema_diff = query_schema_dict != existing_schema_dict
             if schema_diff:
                 if schema_change_behavior == 'drop_and_recreate':
@@ -239,14 +831,15 @@ class Connection:
                         sql.Identifier(schema),
                         sql.Identifier(table)
                     )
-                    self.session.execute(drop_table_query)
+                    statements.append(drop_table_query)
 
                     create_table_query = sql.SQL("CREATE TABLE {}.{} AS ({})").format(
                         sql.Identifier(schema),
                         sql.Identifier(table),
                         sql.SQL(query)
                     )
-                    self.session.execute(create_table_query)
+                    statements.append(create_table_query)
+                    self.catalog.forget(schema)
 
                 elif schema_change_behavior == 'error':
                     raise ValueError(f"Schema mismatch detected between query and existing table {table_name}. Aborting.")
@@ -257,54 +850,54 @@ class Connection:
                 sql.Identifier(table),
                 sql.SQL(query)
             )
-            self.session.execute(create_table_query)
+            statements.append(create_table_query)
+            self.catalog.forget(schema)
 
         # Handle materialization_type logic
         if materialization_type == 'incremental':
             if primary_key is None:
                 raise ValueError("Primary key is required for incremental materialization.")
 
-            # Check if primary key already exists in the table
-            primary_key_exists_query = sql.SQL("""
-                SELECT COUNT(*) 
-                FROM information_schema.table_constraints 
-                WHERE table_schema = %s 
-                AND table_name = %s 
-                AND constraint_type = 'PRIMARY KEY'
-            """)
-            self.session.execute(primary_key_exists_query, (schema, table))
-            primary_key_exists = self.session.fetchone()[0] > 0
-
-            # Add primary key if it doesn't exist
-            if not primary_key_exists:
-                try:
-                    create_primary = sql.SQL("ALTER TABLE {}.{} ADD PRIMARY KEY ({});").format(
-                        sql.Identifier(schema),
-                        sql.Identifier(table),
-                        sql.Identifier(primary_key),
+            # The key and watermark checks below read the table
+            self.send(statements)
+            statements = []
+            self.ensure_primary_key(schema, table, primary_key)
+
+            source = sql.SQL(query)
+            if watermark:
+                if watermark not in query_schema_dict:
+                    raise ValueError(f"Watermark column '{watermark}' is not returned by the query for {table_name}")
+                # Only rows past what is already loaded. The query sees the mark as
+                # {{ this_watermark }} to filter early, the outer filter guarantees it.
+                high_water_mark = self.high_water_mark(schema, table, watermark)
+                print(f"Loading rows of {table_name} with {watermark} > {high_water_mark}")
+                source = sql.SQL(render_watermark(query_template, high_water_mark))
+                if high_water_mark is not None:
+                    source = sql.SQL("SELECT * FROM ({}) AS watermarked WHERE {} > {}").format(
+                        source,
+                        sql.Identifier(watermark),
+                        sql.Literal(high_water_mark)
                     )
-                    self.session.execute(create_primary)
-                except psycopg2.Error as e:
-                    # Ignore if the primary key already exists
-                    if "already exists" not in str(e):
-                        raise e
+
             # Perform insert/update using the query result and primary_key
             update_query = sql.SQL("""
-                INSERT INTO {}.{} ({})
+                INSERT INTO {}.{} AS target ({})
                 SELECT * FROM ({}) AS subquery
                 ON CONFLICT ({}) DO UPDATE 
                 SET {}
+                {}
             """).format(
                 sql.Identifier(schema),
                 sql.Identifier(table),
                 sql.SQL(', ').join(map(sql.Identifier, query_schema_dict.keys())),  # Use the query columns
-                sql.SQL(query),  # The query that generates data
+                source,  # The query that generates data
                 sql.Identifier(primary_key),
                 sql.SQL(', ').join(
                     sql.SQL("{} = EXCLUDED.{}").format(sql.Identifier(col), sql.Identifier(col)) for col in query_schema_dict.keys() if col != primary_key
-                )
+                ),
+                self.changed_condition(schema, table, [col for col in query_schema_dict.keys() if col != primary_key])
             )
-            self.session.execute(update_query)
+            statements.append(update_query)
 
         elif materialization_type == 'truncate':
             # Truncate and insert all data from the query
@@ -312,7 +905,7 @@ class Connection:
                 sql.Identifier(schema),
                 sql.Identifier(table)
             )
-            self.session.execute(truncate_query)
+            statements.append(truncate_query)
         
             insert_query = sql.SQL("""
                 INSERT INTO {}.{} ({})
@@ -323,7 +916,7 @@ class Connection:
                 sql.SQL(', ').join(map(sql.Identifier, query_schema_dict.keys())),  # Use the query columns
                 sql.SQL(query)  # The query that generates data
             )
-            self.session.execute(insert_query)
+            statements.append(insert_query)
 
         elif materialization_type == 'temp':
             # Create a temporary table and insert the query result
@@ -332,15 +925,17 @@ class Connection:
                 sql.Identifier(temp_table_name),
                 sql.SQL(query)  # Use the query to create the temp table
             )
-            self.session.execute(create_temp_table_query)
+            statements.append(create_temp_table_query)
 
         elif materialization_type == 'None':
             # Just run the query and return the result
+            self.send(statements)
             self.session.execute(query)
             result = self.session.fetchall()
             return result
 
-        # Commit the transaction
-        self.conn.commit()
+        self.send(statements)
+        # Commit the transaction, unless it is part of a group
+        self.commit()
 
         print(f"Query results written to {table_name} successfully.")
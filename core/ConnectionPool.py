@@ -0,0 +1,194 @@
+import atexit
+import threading
+import time
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+from core.Catalog import Catalog
+
+
+class ConnectionPool:
+    # One pool per <connection> id and target, shared by every Pipeline in the process
+    _pools = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, db_config, min_size=1, max_size=10, idle_timeout=300, health_check_after=30, acquire_timeout=60):
+        self.db_config = db_config
+        self.min_size = int(min_size)
+        self.max_size = max(int(max_size), self.min_size, 1)
+        self.idle_timeout = float(idle_timeout)
+        self.health_check_after = float(health_check_after)
+        self.acquire_timeout = float(acquire_timeout)
+        self.idle = []  # (conn, released_at), most recently used last
+        self.size = 0
+        self.closed = False
+        self.lock = threading.Condition()
+        # Metadata of the target's schemas, shared by everything using this pool
+        self.catalog = Catalog()
+        # Connections promised to nodes being built, by every run in the process
+        self.reserved = 0
+        self.reservations = threading.Condition()
+        self.fill()
+
+    @classmethod
+    def shared(cls, key, db_config, **options):
+        with cls._registry_lock:
+            pool = cls._pools.get(key)
+            if pool is None or pool.closed:
+                pool = cls(db_config, **options)
+                cls._pools[key] = pool
+            return pool
+
+    @classmethod
+    def close_all(cls):
+        with cls._registry_lock:
+            pools = list(cls._pools.values())
+            cls._pools = {}
+        for pool in pools:
+            pool.close()
+
+    def connect(self):
+        return psycopg2.connect(**self.db_config)
+
+    def fill(self):
+        # Open min_size connections up front, so the first nodes of a run find them warm
+        while True:
+            with self.lock:
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.lock:
+                    self.size -= 1
+                    self.lock.notify()
+                # acquire() reports the error to the node that needs a connection
+                return
+            with self.lock:
+                self.idle.append((conn, time.monotonic()))
+                self.lock.notify()
+
+    def healthy(self, conn, released_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def evict_idle(self):
+        # Close connections that have sat unused for too long, keeping min_size warm
+        now = time.monotonic()
+        expired = []
+        while len(self.idle) > 0 and self.size > self.min_size and now - self.idle[0][1] > self.idle_timeout:
+            conn, _ = self.idle.pop(0)
+            self.size -= 1
+            expired.append(conn)
+        return expired
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise Exception("Connection pool is closed")
+                expired = self.evict_idle()
+                candidate = None
+                if len(self.idle) > 0:
+                    candidate = self.idle.pop()
+                elif self.size < self.max_size:
+                    self.size += 1
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Exception(f"Timed out waiting for a connection to {self.db_config.get('host')} (pool max_size={self.max_size})")
+                    self.lock.wait(remaining)
+                    continue
+            for conn in expired:
+                self.discard(conn)
+
+            if candidate is not None:
+                conn, released_at = candidate
+                if self.healthy(conn, released_at):
+                    return conn
+                self.discard(conn)
+                with self.lock:
+                    self.size -= 1
+                    self.lock.notify()
+                continue
+
+            # A slot was reserved above, open the connection outside the lock
+            try:
+                return self.connect()
+            except Exception:
+                with self.lock:
+                    self.size -= 1
+                    self.lock.notify()
+                raise
+
+    def reserve(self, count, limit):
+        # Claim count of the limit's connections for a node, False when other nodes hold them
+        with self.reservations:
+            if self.reserved + count > limit:
+                return False
+            self.reserved += count
+            return True
+
+    def unreserve(self, count):
+        with self.reservations:
+            self.reserved -= count
+            self.reservations.notify_all()
+
+    def wait_reserved(self, timeout=None):
+        # Until a node of any run gives connections back
+        with self.reservations:
+            self.reservations.wait(timeout)
+
+    def release(self, conn):
+        reusable = not conn.closed
+        if reusable:
+            try:
+                status = conn.get_transaction_status()
+                if status == TRANSACTION_STATUS_UNKNOWN:
+                    reusable = False
+                elif status != TRANSACTION_STATUS_IDLE:
+                    # Never hand out a connection with someone else's open transaction
+                    conn.rollback()
+            except psycopg2.Error:
+                reusable = False
+
+        with self.lock:
+            if reusable and not self.closed:
+                self.idle.append((conn, time.monotonic()))
+            else:
+                self.size -= 1
+            expired = self.evict_idle()
+            self.lock.notify()
+        if not reusable or self.closed:
+            self.discard(conn)
+        for conn in expired:
+            self.discard(conn)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.lock.notify_all()
+        for conn, _ in idle:
+            self.discard(conn)
+
+
+atexit.register(ConnectionPool.close_all)
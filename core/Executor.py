@@ -0,0 +1,512 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import contextlib
+import threading
+import time
+from core.ResultStore import ResultStore
+from core.BuildCache import digest
+
+DEFAULT_MAX_WORKERS = 8
+# When the work of sql nodes is committed: after every node, once per dependency
+# level or once at the end of the run
+COMMIT_MODES = ('node', 'level', 'run')
+# Pool connections a map node holds at once: its own session, the server-side
+# cursor streaming its input and a short one to set up the target schema
+MAP_CONNECTIONS = 3
+# Seconds between attempts to start nodes whose connections are all in use by other runs
+RESERVE_POLL = 0.5
+
+# Builds in progress in this process, keyed by the table they write
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def build_graph(tables, references=None, graph=None):
+    # Map every table to the set of tables it reads from. Inputs that are not
+    # declared in this pipeline (e.g. tables built by another pipeline file)
+    # are treated as external and do not hold up scheduling. references maps
+    # the extra input names of spliced pipelines (e.g. 'kanto.kanto_core') to
+    # their tables, whose own graph is passed in as graph.
+    by_id = {name: list(tables) for name, tables in (references or {}).items()}
+    for table in tables:
+        if table.id:
+            by_id.setdefault(table.id, []).append(table)
+
+    graph = dict(graph) if graph else {}
+    for table in tables:
+        upstream = set()
+        for input_id in table.inputs:
+            for input_table in by_id.get(input_id, []):
+                if input_table is table:
+                    raise Exception(f"Table '{table.id}' lists itself as an input")
+                upstream.add(input_table)
+        graph[table] = upstream
+
+    check_cycles(graph)
+    check_ephemeral(graph)
+    return graph
+
+
+def check_ephemeral(graph):
+    # Ephemeral tables are inlined as CTEs, so sql consumers must query the same
+    # connection. Python consumers read them through the ephemeral table's own.
+    for table, upstream in graph.items():
+        for input_table in upstream:
+            if input_table.materialization == 'ephemeral' and table.type == 'sql' and input_table.connection is not table.connection:
+                raise Exception(f"Ephemeral table '{input_table.id}' is read by '{table.id}' on a different connection")
+
+
+def check_cycles(graph):
+    # Depth first search, raising on the first back edge found
+    visiting, visited = set(), set()
+
+    def visit(table, path):
+        visiting.add(table)
+        for upstream in graph[table]:
+            if upstream in visiting:
+                cycle = path[path.index(upstream):] + [upstream]
+                raise Exception(f"Cycle detected in pipeline inputs: {' -> '.join(t.id for t in reversed(cycle))}")
+            if upstream not in visited:
+                visit(upstream, path + [upstream])
+        visiting.discard(table)
+        visited.add(table)
+
+    for table in graph:
+        if table not in visited:
+            visit(table, [table])
+
+
+def downstream_map(graph):
+    downstream = {table: [] for table in graph}
+    for table, upstream in graph.items():
+        for input_table in upstream:
+            downstream[input_table].append(table)
+    return downstream
+
+
+def python_consumers(graph):
+    # Number of python nodes that take each table's output as a handler input
+    consumers = {}
+    for table, upstream in graph.items():
+        if table.type == 'python':
+            for input_table in upstream:
+                consumers[input_table] = consumers.get(input_table, 0) + 1
+    return consumers
+
+
+def levels(graph):
+    # Depth of every node, the longest chain of inputs above it
+    depth = {}
+
+    def visit(table):
+        if table not in depth:
+            depth[table] = 1 + max((visit(input_table) for input_table in graph[table]), default=-1)
+        return depth[table]
+
+    for table in graph:
+        visit(table)
+    return depth
+
+
+class Flight:
+    # One build of a table. Other runs that want to build the same table wait for
+    # it and reuse its result when they would have built exactly the same thing.
+    def __init__(self, key, fingerprint, sample):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.sample = sample
+        self.done = threading.Event()
+        self.built = False
+        self.version = None
+
+    def reusable(self, fingerprint, sample):
+        return self.built and self.fingerprint == fingerprint and self.sample == sample
+
+
+class TransactionGroup:
+    # SQL nodes of one connection that share a transaction. They run one after the
+    # other on a single thread, which holds the group's database connection.
+    def __init__(self, connection, initializer=None, initargs=()):
+        self.connection = connection
+        self.lane = ThreadPoolExecutor(max_workers=1, initializer=initializer, initargs=initargs)
+        # (table, fingerprint, version) of nodes built in the open transaction
+        self.members = []
+        self.level = None
+        # Id of the node whose failure rolled the group back
+        self.failed = None
+
+    def pending(self, table):
+        return any(member[0] is table for member in self.members)
+
+
+class Executor:
+    def __init__(self, tables, graph=None, max_workers=None, memory_budget=None, cache=None, force_build=False, commit=None, sample=None,
+            slots=None, initializer=None, initargs=(), caches=None, select=None, worker_options=None):
+        self.tables = list(tables)
+        self.graph = graph if graph is not None else build_graph(self.tables)
+        # Nodes this run builds, the others are read from their tables as they are
+        self.selected = set(select) if select is not None else set(self.graph)
+        self.max_workers = int(max_workers) if max_workers else DEFAULT_MAX_WORKERS
+        self.store = ResultStore(python_consumers(self.subgraph()), memory_budget)
+        self.cache = cache
+        # Build caches of the tables of spliced pipelines, keyed by their Pipeline
+        self.caches = dict(caches) if caches else {}
+        self.force_build = force_build
+        self.store.track_versions = cache is not None
+        # Output version of every node once it is built or skipped this run
+        self.versions = {}
+        for table in self.graph:
+            # Nodes left out of the run keep the version of their last recorded build
+            if table not in self.selected and self.cache_for(table) is not None and table.id:
+                entry = self.cache_for(table).get(table.id)
+                if entry is not None:
+                    self.versions[table] = entry['version']
+        self.commit = commit if commit else 'node'
+        if self.commit not in COMMIT_MODES:
+            raise ValueError(f"Unknown commit mode '{self.commit}', expected one of {', '.join(COMMIT_MODES)}")
+        self.levels = levels(self.graph)
+        # Development runs: python components read at most this many rows per input
+        self.sample = int(sample) if sample else None
+        self.store.sample = self.sample
+        self.store.worker_options = worker_options
+        self.groups = {}
+        # Semaphore shared with other executors of the process, one slot per node being built
+        self.slots = slots if slots is not None else contextlib.nullcontext()
+        # Called at the start of every thread the run starts, like ThreadPoolExecutor's
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+
+    def connection_limit(self, connection):
+        if connection is None:
+            return None
+        # Never run more nodes on a connection than its pool can hand out
+        limit = connection.pool_options['max_size']
+        if connection.max_concurrency:
+            limit = min(limit, int(connection.max_concurrency))
+        return limit
+
+    def subgraph(self):
+        return {table: set(i for i in upstream if i in self.selected) for table, upstream in self.graph.items() if table in self.selected}
+
+    def connection_weight(self, table, limit):
+        # Connections the node counts for against its connection's limit, never more than the limit itself
+        weight = MAP_CONNECTIONS if table.mode == 'map' else 1
+        return min(weight, limit) if limit is not None else weight
+
+    def reserve(self, table):
+        # The limit is kept per pool over every run of the process, so concurrent
+        # pipeline runs of a scheduler cannot starve each other of connections
+        limit = self.connection_limit(table.connection)
+        weight = self.connection_weight(table, limit)
+        if limit is not None and not table.connection.pool.reserve(weight, limit):
+            return None
+        return weight if limit is not None else 0
+
+    def unreserve(self, table, weight):
+        if weight:
+            table.connection.pool.unreserve(weight)
+
+    def cache_for(self, table):
+        return self.caches.get(getattr(table, 'pipeline', None), self.cache)
+
+    def fingerprint(self, table):
+        if self.cache_for(table) is None or not table.id:
+            return None
+        # Ids repeat across referenced pipelines, inputs are keyed by file and id
+        from core.Workspace import node_key
+        input_versions = {node_key(input_table): self.versions.get(input_table) for input_table in self.graph[table]}
+        if None in input_versions.values():
+            return None
+        return table.fingerprint(input_versions)
+
+    def up_to_date(self, table, fingerprint):
+        if fingerprint is None or self.force_build or self.sample or not table.cacheable(self.graph):
+            return False
+        return self.cache_for(table).fresh(table.id, fingerprint) and table.exists()
+
+    def begin_flight(self, table, fingerprint):
+        # Returns (flight, None) once this run owns the build of the table, or
+        # (None, flight) when another run just built it the same way
+        key = table.target()
+        if key is None:
+            return None, None
+        while True:
+            with _flights_lock:
+                flight = _flights.get(key)
+                if flight is None:
+                    flight = _flights[key] = Flight(key, fingerprint, self.sample)
+                    return flight, None
+            # The wait can be long, give the connection of the existence check back first
+            if table.connection is not None:
+                table.connection.close()
+            print(f"Waiting for another run that is building \"{table.schema}\".\"{table.table}\" .....")
+            flight.done.wait()
+            if flight.reusable(fingerprint, self.sample):
+                return None, flight
+
+    def end_flight(self, flight):
+        if flight is None:
+            return
+        with _flights_lock:
+            if _flights.get(flight.key) is flight:
+                del _flights[flight.key]
+        flight.done.set()
+
+    def build_table(self, table, group=None):
+        flight = None
+        try:
+            fingerprint = self.fingerprint(table)
+            if table.materialization == 'ephemeral':
+                # Nothing to build, consumers run its query as part of their own.
+                # Its version only changes with its code and inputs.
+                print(f"Table '{table.id}' is ephemeral, inlined into its consumers.\n")
+                self.versions[table] = fingerprint if fingerprint is not None else digest([table.code, time.time()])
+                return
+            if self.up_to_date(table, fingerprint):
+                print(f"Skipping Table '{table.id}', unchanged since its last build.\n")
+                self.versions[table] = self.cache_for(table).get(table.id)['version']
+                return
+            # Grouped builds only count once their transaction commits, so they are not shared
+            if group is None:
+                flight, joined = self.begin_flight(table, fingerprint)
+                if joined is not None:
+                    print(f"Table '{table.id}' was just built by another run, reusing it.\n")
+                    self.versions[table] = joined.version
+                    return
+            print(f"Building Table '{table.id}' .....")
+            with self.slots:
+                table.build(store=self.store)
+            # Python outputs are versioned by content, so an identical result
+            # still lets downstream nodes skip. Anything else counts as new.
+            version = self.store.versions.get(table)
+            if version is None:
+                version = digest([fingerprint, time.time()])
+            self.versions[table] = version
+            if self.sample:
+                # Built from sampled inputs, the next full run has to build it again
+                if self.cache_for(table) is not None and table.id:
+                    self.cache_for(table).forget(table.id)
+            elif group is not None:
+                # Recorded once the group's transaction commits
+                group.members.append((table, fingerprint, version))
+            elif fingerprint is not None and table.cacheable(self.graph):
+                self.cache_for(table).record(table.id, fingerprint, version)
+            if flight is not None:
+                flight.built = True
+                flight.version = version
+            print("Done.\n")
+        except Exception:
+            # A failed build may have changed the table, never trust the old entry
+            if self.cache_for(table) is not None and table.id:
+                self.cache_for(table).forget(table.id)
+            # Catalog updates made before the rollback no longer hold either
+            if table.connection is not None and table.schema:
+                table.connection.catalog.forget(table.schema)
+            raise
+        finally:
+            self.end_flight(flight)
+            # Hand the thread's session back so the next node starts clean. A
+            # group keeps it for the rest of its transaction.
+            if table.connection is not None and group is None:
+                table.connection.close()
+            if table.type == 'python':
+                for input_table in self.graph[table]:
+                    self.store.consumed(input_table)
+
+    def grouped(self, table):
+        return self.commit != 'node' and table.type == 'sql' and table.connection is not None \
+            and table.materialization != 'ephemeral'
+
+    def group(self, table):
+        if table.connection not in self.groups:
+            self.groups[table.connection] = TransactionGroup(table.connection, self.initializer, self.initargs)
+        return self.groups[table.connection]
+
+    def build_grouped(self, table):
+        # Runs on the group's own thread
+        group = self.group(table)
+        if group.failed is not None:
+            raise Exception(f"Not built, the transaction was rolled back after '{group.failed}' failed")
+        level = self.levels[table] if self.commit == 'level' else None
+        if len(group.members) > 0 and group.level != level:
+            self.commit_group(group)
+        group.level = level
+        table.connection.begin_group()
+        try:
+            self.build_table(table, group)
+        except Exception:
+            self.rollback_group(group, table)
+            raise
+
+    def commit_group(self, group):
+        # Runs on the group's own thread
+        if group.failed is not None:
+            raise Exception(f"The transaction was rolled back after '{group.failed}' failed")
+        group.connection.end_group(commit=True)
+        members, group.members = group.members, []
+        for table, fingerprint, version in members:
+            if fingerprint is not None and table.cacheable(self.graph):
+                self.cache_for(table).record(table.id, fingerprint, version)
+        if len(members) > 0:
+            print(f"Committed {', '.join(repr(member[0].id) for member in members)} in one transaction.\n")
+
+    def rollback_group(self, group, failed):
+        group.connection.end_group(commit=False)
+        members, group.members = group.members, []
+        for table, _, _ in members:
+            if self.cache_for(table) is not None and table.id:
+                self.cache_for(table).forget(table.id)
+            if table.schema:
+                table.connection.catalog.forget(table.schema)
+        group.failed = failed.id
+        if len(members) > 0:
+            print(f"Rolled back {', '.join(repr(member[0].id) for member in members)} after '{failed.id}' failed.\n")
+
+    def finish_group(self, group):
+        try:
+            if group.failed is None:
+                self.commit_group(group)
+        finally:
+            group.connection.close()
+
+    def read_tables(self, table):
+        # Tables a node's statement actually reads. Ephemeral inputs are inlined into
+        # it, so the tables behind them count instead.
+        tables = set()
+        for input_table in self.graph[table]:
+            if input_table.materialization == 'ephemeral':
+                tables.update(self.read_tables(input_table))
+            else:
+                tables.add(input_table)
+        return tables
+
+    def flush(self, table):
+        # Commit the groups holding uncommitted inputs of a node that reads them
+        # from another transaction. Ephemeral nodes run nothing, their consumers
+        # read the inputs.
+        if table.materialization == 'ephemeral':
+            return []
+        own = self.groups.get(table.connection) if self.grouped(table) else None
+        return [group.lane.submit(self.commit_group, group) for group in self.groups.values()
+            if group is not own and any(group.pending(input_table) for input_table in self.read_tables(table))]
+
+    def build_after(self, commits, table):
+        for commit in commits:
+            commit.result()
+        self.build_table(table)
+
+    def submit(self, pool, table):
+        commits = self.flush(table)
+        if self.grouped(table):
+            # Waiting here rather than on a group's thread, so groups never wait on each other
+            try:
+                for commit in commits:
+                    commit.result()
+            except Exception as E:
+                failed = Future()
+                failed.set_exception(E)
+                return failed
+            return self.group(table).lane.submit(self.build_grouped, table)
+        return pool.submit(self.build_after, commits, table)
+
+    def close_groups(self):
+        errors = []
+        for group in self.groups.values():
+            try:
+                group.lane.submit(self.finish_group, group).result()
+            except Exception as E:
+                errors.append(E)
+            group.lane.shutdown()
+        self.groups = {}
+        if errors:
+            raise errors[0]
+
+    def connections(self):
+        # Target schemas of this run, per connection
+        schemas = {}
+        for table in self.tables:
+            if table.connection is not None and table.schema:
+                schemas.setdefault(table.connection, set()).add(table.schema)
+        return schemas
+
+    def open_catalogs(self):
+        # Read the metadata of every target schema once per connection. Schema,
+        # table, column and primary key checks of this run are then answered from
+        # memory, and the engine's own DDL keeps the catalog current.
+        for connection, schemas in self.connections().items():
+            connection.catalog.begin(self.store.run_id)
+            connection.Session()
+            try:
+                connection.catalog.load(connection.session, schemas)
+            finally:
+                connection.close()
+
+    def close_catalogs(self):
+        for connection in self.connections():
+            connection.catalog.end(self.store.run_id)
+
+    def run(self):
+        try:
+            self.open_catalogs()
+            try:
+                self.schedule()
+            finally:
+                self.close_groups()
+        finally:
+            self.close_catalogs()
+
+    def schedule(self):
+        pending = self.subgraph()
+        downstream = downstream_map(pending)
+        # Keep declaration order among ready nodes so runs stay predictable
+        ready = [table for table in self.tables if table in pending and not pending[table]]
+        running = {}
+        errors = []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, initializer=self.initializer, initargs=self.initargs) as pool:
+            try:
+                while ready or running:
+                    if not errors:
+                        for table in list(ready):
+                            weight = self.reserve(table)
+                            if weight is None:
+                                continue
+                            ready.remove(table)
+                            try:
+                                running[self.submit(pool, table)] = (table, weight)
+                            except Exception:
+                                self.unreserve(table, weight)
+                                raise
+                    else:
+                        # Stop scheduling after a failure and let in-flight nodes finish
+                        ready = []
+                    if not running:
+                        if not ready:
+                            break
+                        # Every ready node waits for connections other runs are using
+                        ready[0].connection.pool.wait_reserved(RESERVE_POLL)
+                        continue
+
+                    # Ready nodes that found no free connection are retried now and then
+                    done, _ = wait(running, timeout=RESERVE_POLL if ready else None, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        table, weight = running.pop(future)
+                        self.unreserve(table, weight)
+                        try:
+                            future.result()
+                        except Exception as E:
+                            print(f"Table '{table.id}' failed: {E}")
+                            errors.append(E)
+                            continue
+                        for child in downstream[table]:
+                            pending[child].discard(table)
+                            if not pending[child]:
+                                ready.append(child)
+            finally:
+                # Connections of nodes still running when the loop is left are given back once they end
+                wait(running)
+                for table, weight in running.values():
+                    self.unreserve(table, weight)
+
+        self.store.clear()
+        if errors:
+            raise errors[0]
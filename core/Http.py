@@ -0,0 +1,211 @@
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+from core.HttpCache import CachedSession, CacheStats
+
+# Attributes of an <http> component, passed on to HttpSource
+HTTP_ATTRIBUTES = ('url', 'list_url', 'list_path', 'next_path', 'concurrency', 'rate_limit', 'retries', 'backoff', 'on_error',
+    'cache_ttl', 'response_cache')
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RETRIES = 3
+# Seconds before the first retry, doubled for every further attempt
+DEFAULT_BACKOFF = 0.5
+DEFAULT_TIMEOUT = 30
+# Responses that are worth another attempt
+RETRY_STATUS = {429, 500, 502, 503, 504}
+PATH_STEP = re.compile(r'([^.\[\]]+)|\[([^\]]*)\]')
+JOIN_TRANSFORM = re.compile(r'''join\((['"])(.*)\1\)$''')
+
+
+def parse_path(path):
+    # "stats[stat.name=hp].base_stat" -> [('stats', None), (None, 'stat.name=hp'), ('base_stat', None)]
+    return [(key if key else None, selector if not key else None) for key, selector in PATH_STEP.findall(path.strip())]
+
+
+def extract(value, steps):
+    # Follow a parsed path through a JSON document. [*] maps the rest of the path
+    # over a list, [n] indexes it and [field=value] picks the first matching item.
+    for position, (key, selector) in enumerate(steps):
+        if value is None:
+            return None
+        if key is not None:
+            value = value.get(key) if isinstance(value, dict) else None
+        elif not isinstance(value, list):
+            return None
+        elif selector == '*':
+            return [extract(item, steps[position + 1:]) for item in value]
+        elif re.fullmatch(r'-?\d+', selector):
+            index = int(selector)
+            value = value[index] if -len(value) <= index < len(value) else None
+        else:
+            field, _, expected = selector.partition('=')
+            field_steps = parse_path(field)
+            value = next((item for item in value if str(extract(item, field_steps)) == expected.strip()), None)
+    return value
+
+
+def parse_transform(transform):
+    match = JOIN_TRANSFORM.match(transform)
+    if match:
+        separator = match.group(2)
+        return lambda value: separator.join(str(v) for v in value if v is not None) if isinstance(value, list) else value
+    if transform == 'json':
+        return lambda value: json.dumps(value) if value is not None else None
+    raise Exception(f"Unknown http field transform '{transform}', expected join('...') or json")
+
+
+def parse_fields(spec):
+    # One "column: path | transform" per line of the component's body
+    fields = []
+    for line in (spec or '').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        column, separator, rest = line.partition(':')
+        if not separator or not column.strip() or not rest.strip():
+            raise Exception(f"Invalid http field '{line}', expected column: path")
+        path, *transforms = [part.strip() for part in rest.split('|')]
+        fields.append((column.strip(), parse_path(path), [parse_transform(t) for t in transforms]))
+    return fields
+
+
+def apply(value, transforms):
+    for transform in transforms:
+        value = transform(value)
+    return value
+
+
+class HttpSource:
+    # Fetches a JSON API into a DataFrame: optionally a (paginated) list of items
+    # first, then one request per item, on a bounded pool of keep-alive sessions
+    def __init__(self, url=None, list_url=None, list_path=None, next_path=None, concurrency=None, rate_limit=None,
+            retries=None, backoff=None, on_error=None, cache_ttl=None, response_cache=None, timeout=None, fields=None):
+        if not url and not list_url:
+            raise Exception("An http component needs a url, a list_url or both")
+        self.url = url if url else None
+        self.list_url = list_url if list_url else None
+        self.list_path = parse_path(list_path) if list_path else None
+        self.next_path = parse_path(next_path) if next_path else None
+        self.concurrency = int(concurrency) if concurrency else DEFAULT_CONCURRENCY
+        # Requests per second over all sessions
+        self.rate_limit = float(rate_limit) if rate_limit else None
+        self.retries = int(retries) if retries not in (None, '') else DEFAULT_RETRIES
+        self.backoff = float(backoff) if backoff not in (None, '') else DEFAULT_BACKOFF
+        self.on_error = on_error if on_error else 'fail'
+        if self.on_error not in ('fail', 'skip'):
+            raise Exception(f"Unknown on_error '{self.on_error}', expected fail or skip")
+        self.timeout = float(timeout) if timeout else DEFAULT_TIMEOUT
+        # Seconds a cached response is used without asking the server, after that it is revalidated
+        self.cache_ttl = float(cache_ttl) if cache_ttl else None
+        self.response_cache = response_cache != 'false'
+        self.cache = None
+        self.stats = CacheStats()
+        self.fields = parse_fields(fields)
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.next_slot = 0.0
+
+    def session(self):
+        # One keep-alive session per fetching thread
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = CachedSession(self.cache, self.cache_ttl, self.stats) if self.cache is not None else requests.Session()
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def throttle(self):
+        if self.rate_limit is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1 / self.rate_limit
+        if slot > now:
+            time.sleep(slot - now)
+
+    def get(self, url):
+        error = None
+        for attempt in range(self.retries + 1):
+            self.throttle()
+            delay = self.backoff * 2 ** attempt
+            try:
+                response = self.session().get(url, timeout=self.timeout)
+            except requests.RequestException as E:
+                error = Exception(f"GET {url} failed: {E}")
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                error = Exception(f"GET {url} returned status {response.status_code}")
+                if response.status_code not in RETRY_STATUS:
+                    break
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            if attempt < self.retries:
+                time.sleep(delay)
+        raise error
+
+    def list_items(self):
+        # Every item of the list endpoint, following next_path from page to page
+        items = []
+        url = self.list_url
+        while url:
+            document = self.get(url)
+            page = extract(document, self.list_path) if self.list_path else document
+            items.extend(page if isinstance(page, list) else [page])
+            url = extract(document, self.next_path) if self.next_path else None
+        return items
+
+    def fetch_item(self, item):
+        # The url is a template filled in from the item, e.g. {pokemon_species[name]} or {item}
+        values = dict(item, item=item) if isinstance(item, dict) else {'item': item}
+        url = self.url.format_map(values)
+        try:
+            return self.get(url)
+        except Exception as E:
+            if self.on_error == 'fail':
+                raise
+            print(f"Skipped: {E}")
+            return None
+
+    def rows(self, documents):
+        if len(self.fields) == 0:
+            return pd.json_normalize(documents)
+        return pd.DataFrame([
+            {column: apply(extract(document, steps), transforms) for column, steps, transforms in self.fields}
+            for document in documents
+        ], columns=[column for column, _, _ in self.fields])
+
+    def fetch(self, cache=None):
+        self.cache = cache if self.response_cache else None
+        self.stats = CacheStats()
+        try:
+            if self.list_url is not None:
+                items = self.list_items()
+            else:
+                items = [None]
+            if self.url is None:
+                documents = items
+            else:
+                # Results come back in list order whatever order the responses arrive in
+                with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                    documents = [d for d in pool.map(self.fetch_item, items) if d is not None]
+                if self.list_url is None and self.list_path:
+                    # A single document holding the rows
+                    documents = [row for document in documents for row in (extract(document, self.list_path) or [])]
+            if self.stats.requests > 0:
+                print(f"HTTP cache: {self.stats.summary()}")
+            return self.rows(documents)
+        finally:
+            with self.lock:
+                sessions, self.sessions = self.sessions, []
+            for session in sessions:
+                session.close()
+            self.local = threading.local()
@@ -0,0 +1,199 @@
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+from core.BuildCache import CACHE_DIR
+
+# Megabytes of response bodies kept on disk before the least recently used are evicted
+DEFAULT_MAX_SIZE = 256
+# Headers kept with a body and sent back to the server to revalidate it
+VALIDATORS = {'ETag': 'If-None-Match', 'Last-Modified': 'If-Modified-Since'}
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+_current = threading.local()
+
+
+class CacheStats:
+    # Hits answered from disk, 304 revalidations and full fetches of one node
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def add(self, outcome):
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    @property
+    def requests(self):
+        return self.hits + self.revalidated + self.misses
+
+    def summary(self):
+        return f"{self.hits} cached, {self.revalidated} revalidated, {self.misses} fetched"
+
+
+@contextlib.contextmanager
+def track(stats=None):
+    # Sessions created on this thread inside the block count into the same stats
+    previous = getattr(_current, 'stats', None)
+    _current.stats = stats if stats is not None else CacheStats()
+    try:
+        yield _current.stats
+    finally:
+        _current.stats = previous
+
+
+class HttpCache:
+    # On-disk cache of GET response bodies, keyed by URL and shared by every
+    # pipeline and worker process of a checkout. A body is stored as <key>.body
+    # next to <key>.json, whose modification time records its last use.
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory if directory else os.path.join(CACHE_DIR, 'http')
+        self.max_size = int(max_size * 1024 * 1024) if max_size else DEFAULT_MAX_SIZE * 1024 * 1024
+        self.lock = threading.Lock()
+        # Bytes on disk, counted on the first write
+        self.size = None
+
+    def paths(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, f"{key}.json"), os.path.join(self.directory, f"{key}.body")
+
+    def lookup(self, url):
+        meta_path, body_path = self.paths(url)
+        try:
+            with open(meta_path) as f:
+                entry = json.load(f)
+            with open(body_path, 'rb') as f:
+                entry['body'] = f.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def fresh(self, entry, ttl):
+        return ttl is not None and time.time() - entry['validated_at'] < ttl
+
+    def validators(self, entry):
+        if entry is None:
+            return {}
+        return {header: entry['headers'][name] for name, header in VALIDATORS.items() if name in entry['headers']}
+
+    def response(self, entry):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = entry['url']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['body']
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def write_meta(self, url, headers):
+        meta_path, _ = self.paths(url)
+        temp_path = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'url': url, 'headers': headers, 'validated_at': time.time()}, f)
+        os.replace(temp_path, meta_path)
+
+    def store(self, url, response):
+        if 'no-store' in response.headers.get('Cache-Control', ''):
+            return
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        meta_path, body_path = self.paths(url)
+        os.makedirs(self.directory, exist_ok=True)
+        # Body first, so a meta file never points at a missing or partial body
+        temp_path = f"{body_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(temp_path, body_path)
+        self.write_meta(url, headers)
+        with self.lock:
+            if self.size is None:
+                self.size = self.disk_size()
+            else:
+                self.size += len(response.content)
+            if self.size > self.max_size:
+                self.evict()
+
+    def revalidated(self, url, entry, response):
+        # A 304 may carry newer validators
+        headers = dict(entry['headers'])
+        headers.update({name: response.headers[name] for name in KEPT_HEADERS if name in response.headers})
+        self.write_meta(url, headers)
+
+    def touch(self, url):
+        try:
+            os.utime(self.paths(url)[0])
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        # (last use, size, meta path, body path) of every entry on disk
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            meta_path = os.path.join(self.directory, name)
+            body_path = meta_path[:-len('.json')] + '.body'
+            try:
+                entries.append((os.stat(meta_path).st_mtime, os.stat(body_path).st_size, meta_path, body_path))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def disk_size(self):
+        return sum(size for _, size, _, _ in self.entries())
+
+    def evict(self):
+        # Least recently used first, down to 90% of the budget so every write does not evict
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _, _ in entries)
+        for _, size, meta_path, body_path in entries:
+            if self.size <= self.max_size * 0.9:
+                break
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.size -= size
+
+
+class CachedSession(requests.Session):
+    # requests.Session whose GETs go through an HttpCache. A stored response younger
+    # than ttl seconds is returned without a request, an older one is revalidated
+    # with If-None-Match / If-Modified-Since and reused when the server answers 304.
+    def __init__(self, cache=None, ttl=None, stats=None):
+        super().__init__()
+        self.cache = cache if cache is not None else HttpCache()
+        self.ttl = float(ttl) if ttl else None
+        self.stats = stats if stats is not None else (getattr(_current, 'stats', None) or CacheStats())
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() != 'GET' or kwargs.get('stream') or args:
+            return super().request(method, url, *args, **kwargs)
+        key = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+        entry = self.cache.lookup(key)
+        if entry is not None and self.cache.fresh(entry, self.ttl):
+            self.cache.touch(key)
+            self.stats.add('hits')
+            return self.cache.response(entry)
+        kwargs['headers'] = dict(kwargs.get('headers') or {}, **self.cache.validators(entry))
+        response = super().request(method, url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.revalidated(key, entry, response)
+            self.stats.add('revalidated')
+            return self.cache.response(entry)
+        self.stats.add('misses')
+        if response.status_code == 200:
+            self.cache.store(key, response)
+        return response
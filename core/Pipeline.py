@@ -1,13 +1,20 @@
 from core import Task
 from core import Connection
 from core import Table
-import re
-from jinja2 import Template
+from core.Executor import Executor, build_graph
+from core.WorkerPool import WorkerPool
+from core.BuildCache import BuildCache
+from core.Plan import load_plan, render, VARIABLES_FILE
+from core.Http import HTTP_ATTRIBUTES
+from core.HttpCache import HttpCache
+from core.Selection import select_tables
+import argparse
 import json
 import sys
 import os
 import logging
 import datetime
+import threading
 
 # Define the PrintLogger class for capturing stdout and stderr
 class PrintLogger:
@@ -23,6 +30,28 @@ class PrintLogger:
         pass  # For file-like object compatibility
 
 
+class ThreadLogger:
+    # Stands in for stdout and stderr in a process that runs several pipelines at
+    # once. Threads bound to a run write to that run's logger, others to the fallback.
+    local = threading.local()
+
+    def __init__(self, fallback, level):
+        self.fallback = fallback
+        self.level = level
+
+    def write(self, message):
+        if message.strip():
+            logger = getattr(ThreadLogger.local, 'logger', None)
+            (logger if logger is not None else self.fallback).log(self.level, message)
+
+    def flush(self):
+        pass
+
+    @staticmethod
+    def bind(logger):
+        ThreadLogger.local.logger = logger
+
+
 class PipelineLogger:
     def __init__(self,fname):
         file_name=fname+'__'+datetime.datetime.now().__str__().replace("-","_").replace(" ","__").replace(":","_").split(".")[0]
@@ -46,78 +75,49 @@ class PipelineLogger:
 
 def xml(xml_string):
     # Load your variables.json file
-    with open('variables.json') as f:
+    with open(VARIABLES_FILE) as f:
         variables = json.load(f)
-    template = Template(xml_string)
-    xml_string = template.render(variables)
-
-    
-    # Regular expression patterns to match different elements
-    tag_pattern = re.compile(r'<(?P<tag>[a-z]+) (?P<attributes>[^>]+)>(?P<content>.*?)</\1>', re.DOTALL)
-    attr_pattern = re.compile(r'(?P<key>[a-z_]+)="(?P<value>[^"]*)"')
-    
-    elements_list = []
-
-    # Find all tags with their attributes and content
-    for match in tag_pattern.finditer(xml_string):
-        tag_dict = {}
-        # Extract the tag name, attributes, and inner content
-        tag = match.group('tag')
-        attributes = match.group('attributes')
-        content = match.group('content').strip()
-
-        # Parse attributes
-        for attr_match in attr_pattern.finditer(attributes):
-            key = attr_match.group('key')
-            value = attr_match.group('value')
-            tag_dict[key] = value
-
-        # Add the content as 'code'
-        tag_dict['code'] = content
-
-        # Add the tag name as 'type'
-        tag_dict['type'] = tag
-
-        # Append the tag dictionary to the list
-        elements_list.append(tag_dict)
-
-    return elements_list
+    return render(xml_string, variables)
 
 
 # Example usage
 # Define the path to the XML file
 def parser(xml_file_path):
-    # Open and read the file content into a string
-    with open(xml_file_path, 'r') as file:
-        xml_string = file.read()
-    
-    # Parse the XML string
-    elements_list = xml(xml_string)
-    
-    # Output the result
-    data = []
-    for element in elements_list:
-        data.append(element)
-    return data
+    # Parsed elements of the file, compiled once and cached until the file or variables.json change
+    return [dict(element) for element in load_plan(xml_file_path).elements]
 
 
 
 #Parse & Load raw data 
 class Pipeline:
-    def __init__(self, file):
-        data=parser(file)
+    def __init__(self, file, parents=(), connections=()):
+        self.file_name=file
+        # Files of the pipelines that reference this one, to reject reference cycles
+        self.parents=tuple(parents)
+        # Connections of the referencing pipeline, reused for <connection> elements declared the same way
+        self.shared_connections=list(connections)
+        self.load(load_plan(file))
+    def load(self,plan):
+        self.plan=plan
+        data=[dict(element) for element in plan.elements]
+        pipelines_raw=[i for i in data if i['type']=='pipeline']
         connections_raw=[i for i in data if i['type']=='connection']
         tasks_raw=[i for i in data if i['type']=='task']
-        table_raw=[i for i in data if i['type']=='sql' or i['type']=='python']
+        table_raw=[i for i in data if i['type']=='sql' or i['type']=='python' or i['type']=='http']
 
 
-        self.file_name=file
         self.connections=[Connection(id=connection['id'],
         host=connection['host'],
         port=connection['port'],
         username=connection['username'],
         password=connection['password'],
-        database=connection['database']) for connection in connections_raw]
+        database=connection['database'],
+        max_concurrency=connection.get('max_concurrency',''),
+        pool_min_size=connection.get('pool_min_size',''),
+        pool_max_size=connection.get('pool_max_size',''),
+        pool_idle_timeout=connection.get('pool_idle_timeout','')) for connection in connections_raw]
+        # One Connection object per connection of the whole run, so limits and sessions are counted once
+        self.connections=[next((i for i in self.shared_connections if i.config()==connection.config()),connection) for connection in self.connections]
         
         self.tables=[Table(table.get('id',''),
             table.get('table',''),
@@ -129,7 +129,20 @@ class Pipeline:
             table.get('inputs',''),
             table.get('schema_change',''),
             table.get('code',''),
-            table.get('type',''),table.get('handler',''),self) for table in table_raw]
+            table.get('type',''),table.get('handler',''),self,
+            table.get('chunksize',''),
+            table.get('runtime',''),
+            table.get('timeout',''),
+            table.get('cache',''),
+            table.get('column_types',''),
+            table.get('watermark',''),
+            table.get('write_parallelism',''),
+            table.get('input_columns',''),
+            table.get('input_filter',''),
+            table.get('sample',''),
+            table.get('mode',''),
+            {key:table[key] for key in HTTP_ATTRIBUTES if key in table},
+            table.get('tags','')) for table in table_raw]
         
         self.tasks=[Task(task['id'],
         task['schedule'],
@@ -137,23 +150,140 @@ class Pipeline:
         [i for i in self.tables if i.id in task.get('steps',[])],
         task.get('force_build',''),
         task.get('code',''),
-        task.get('type',''),self) for task in tasks_raw]
+        task.get('type',''),self,
+        task.get('max_workers',''),
+        task.get('python_workers',''),
+        task.get('worker_max_tasks',''),
+        task.get('worker_max_memory',''),
+        task.get('result_memory',''),
+        task.get('commit',''),
+        task.get('http_cache_size',''),
+        task.get('max_instances','')) for task in tasks_raw]
+
+        # Referenced pipelines are spliced into this one's graph. Their tables are
+        # inputs under '<id>.<table id>', or all of them at once under '<id>'.
+        self.pipelines={}
+        for reference in pipelines_raw:
+            path=reference.get('ref','')
+            if os.path.abspath(path) in self.parents+(os.path.abspath(self.file_name),):
+                raise Exception(f"Pipeline {path} is referenced by itself through {self.file_name}")
+            self.pipelines[reference['id']]=Pipeline(path,self.parents+(os.path.abspath(self.file_name),),self.shared_connections+self.connections)
+        self.references={}
+        child_graph={}
+        for pipeline_id,pipeline in self.pipelines.items():
+            self.references[pipeline_id]=pipeline.all_tables()
+            for table in pipeline.all_tables():
+                self.references.setdefault(f"{pipeline_id}.{table.id}",[]).append(table)
+            for name,tables in pipeline.references.items():
+                self.references[f"{pipeline_id}.{name}"]=tables
+            child_graph.update(pipeline.graph)
+
+        # Resolve the inputs graph up front so cycles are rejected at load time
+        self.graph=build_graph(self.tables,self.references,child_graph)
+    def stale(self):
+        return load_plan(self.file_name).digest!=self.plan.digest or any(i.stale() for i in self.pipelines.values())
+    def reload(self):
+        # Pick up edits to the pipeline file, the ones it references or variables.json, returns True if anything changed
+        if not self.stale():
+            return False
+        self.load(load_plan(self.file_name))
+        return True
+    def all_tables(self):
+        # Own tables after those of the referenced pipelines
+        return [table for pipeline in self.pipelines.values() for table in pipeline.all_tables()]+self.tables
+    def descendants(self):
+        return [p for pipeline in self.pipelines.values() for p in [pipeline]+pipeline.descendants()]
+    def input_tables(self,table):
+        # Tables a component reads, in declaration order, followed by the ones of referenced pipelines
+        own=[i for i in self.tables if i.id in table.inputs]
+        return own+[i for name in table.inputs if '.' in name for i in self.references.get(name,[])]
+    def log_name(self):
+        return str(self.file_name).replace('pipelines/','').replace('.xml','')
     def get_table(self,table_id):
         tbl=[i for i in self.tables if i.id==table_id]
         if len(tbl)==0:
             raise Exception("Table not found")
         else:
             return tbl[0]
-    def run(self):
-        log_name= str(self.file_name).replace('pipelines/','').replace('.xml','')
-        PipelineLogger(log_name)
-        for table in self.tables:
-            print(f"Building Table '{table.id}' .....")
-            self.get_table(table.id).build()
-            print("Done.\n")
+    def compiled_sql(self,table_id):
+        # The statement a sql component runs, with its ephemeral inputs inlined
+        return self.get_table(table_id).compiled_sql()
+    def rollback(self,table_id):
+        # Put back the version a swap materialization replaced
+        table=self.get_table(table_id)
+        try:
+            table.connection.rollback_swap(table.schema,table.table)
+        finally:
+            table.connection.close()
+    def task(self,task_id=None):
+        tasks=[i for i in self.tasks if task_id is None or i.id==task_id]
+        return tasks[0] if len(tasks)>0 else None
+    def run(self,max_workers=None,force_build=None,commit=None,sample=None,task=None,logger=None,slots=None,select=None,exclude=None,defer=False):
+        # task picks the <task> whose options apply (Defaults to the first one).
+        # select and exclude limit the run to part of the graph, see select_tables.
+        # logger and slots are given by a Scheduler that runs several pipelines in one process.
+        log_name=self.log_name()
+        if logger is None:
+            PipelineLogger(log_name)
+        else:
+            ThreadLogger.bind(logger)
+        if self.reload():
+            print(f"Reloaded {self.file_name}, its source changed since the last run")
+        options=self.task(task)
+        if max_workers is None and options is not None:
+            max_workers=options.max_workers
+        tables=self.all_tables()
+        worker_options=self.worker_options(task)
+        if any(t.type=='python' and t.runtime=='worker' for t in tables):
+            # Warm the python workers while the first SQL nodes run
+            WorkerPool.shared(**worker_options)
+        memory_budget=None
+        if options is not None and options.result_memory:
+            memory_budget=options.result_memory*1024*1024
+        if force_build is None:
+            force_build=options is not None and options.force_build
+        if commit is None and options is not None:
+            commit=options.commit
+        # Tables of referenced pipelines keep using their own file's build cache
+        caches={pipeline:BuildCache(pipeline.log_name()) for pipeline in self.descendants()}
+        selected=None
+        if select or exclude or defer:
+            selected=select_tables(self,select,exclude,defer)
+            print(f"Selected {len(selected)} of {len(tables)} tables: {', '.join(i.id for i in tables if i in selected)}")
+        Executor(tables,self.graph,max_workers=max_workers,memory_budget=memory_budget,
+            cache=BuildCache(log_name),caches=caches,force_build=force_build,commit=commit,sample=sample,
+            slots=slots,initializer=ThreadLogger.bind if logger is not None else None,initargs=(logger,),select=selected,
+            worker_options=worker_options).run()
+    def worker_options(self,task=None):
+        # WorkerPool options of a task (Defaults to the first one)
+        options={}
+        task=self.task(task)
+        if task is not None:
+            options['size']=task.python_workers
+            options['max_tasks']=task.worker_max_tasks
+            options['max_memory']=task.worker_max_memory*1024*1024 if task.worker_max_memory else None
+        return options
+    def http_cache(self):
+        # Response cache of the http components, shared with other pipelines on disk
+        size=self.tasks[0].http_cache_size if len(self.tasks)>0 else None
+        return HttpCache(max_size=size)
     def start(self):
-        return self.tasks[0].start()
-
-
+        # Schedules every task of this file, see Scheduler for running all pipelines in one process
+        from core.Scheduler import Scheduler
+        print(f"Starting Pipeline {self.file_name}")
+        Scheduler(pattern=self.file_name,socket_path=None,log_file=None).serve()
 
 
+def main():
+    # Runs one pipeline file now, in the foreground, e.g. bin/pipeline kanto --select "kanto_conf+"
+    parser=argparse.ArgumentParser(description='Run a pipeline once, or part of it')
+    parser.add_argument('pipeline',help='file in pipelines/, with or without .xml')
+    parser.add_argument('--select',help='node, +node (and its ancestors), node+ (and its descendants) or tag:name, comma separated')
+    parser.add_argument('--exclude',help='nodes to leave out, same syntax as --select')
+    parser.add_argument('--defer',action='store_true',help='read the inputs of the selection from their tables, only build the ones that have none yet')
+    parser.add_argument('--task',help='task whose options apply')
+    parser.add_argument('--force-build',action='store_true',default=None)
+    parser.add_argument('--sample',type=int)
+    args=parser.parse_args()
+    file=args.pipeline if os.path.exists(args.pipeline) else f"pipelines/{args.pipeline.replace('.xml','')}.xml"
+    Pipeline(file).run(force_build=args.force_build,sample=args.sample,task=args.task,select=args.select,exclude=args.exclude,defer=args.defer)
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import types
+from jinja2 import Template
+from core.BuildCache import CACHE_DIR
+
+VARIABLES_FILE = 'variables.json'
+# Bump when the parsed layout changes so plans written by older versions are ignored
+PLAN_FORMAT = 3
+# Variables only known when a component runs. They are left in the compiled plan
+# as placeholders and filled in by the engine.
+WATERMARK_PLACEHOLDER = '{{ this_watermark }}'
+RUNTIME_VARIABLES = {'this_watermark': WATERMARK_PLACEHOLDER}
+# name="value", name='value', name=value or a bare name inside a start tag
+ATTRIBUTE = re.compile(r'''([^\s/>="']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+)))?''')
+# Start tag of an element, a quoted attribute value may contain '>'
+START_TAG = re.compile(r'''<([A-Za-z][^\s/>]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+# A start tag that is not complete yet
+PARTIAL_START_TAG = re.compile(r'''<(?:[A-Za-z][^\s/>]*(?:[^>"']|"[^"]*"|'[^']*')*(?:"[^"]*|'[^']*)?)?''')
+# An end tag that is not complete yet
+PARTIAL_END_TAG = re.compile(r'<(?:/[^\s/>]*\s*)?')
+# Markup skipped between elements: comments, processing instructions and declarations
+SKIPPED = (('<!--', '-->'), ('<?', '>'), ('<!', '>'))
+
+# Plans already loaded by this process, keyed by (pipeline file, variables file)
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def raw_attributes(start_tag):
+    # Attribute values exactly as written. HTMLParser would turn character references
+    # into characters, e.g. the '&not' in a query string like '?a=1&not=2' into '¬'.
+    attributes = {}
+    body = re.sub(r'^<\s*[^\s/>]+', '', start_tag).rstrip('>').rstrip('/')
+    for match in ATTRIBUTE.finditer(body):
+        name, double, single, bare = match.groups()
+        value = double if double is not None else single if single is not None else bare
+        attributes.setdefault(name.lower(), value if value is not None else '')
+    return attributes
+
+
+class ElementTokenizer:
+    # Streaming tokenizer for pipeline files. Every top level element becomes one
+    # dict of its attributes plus 'type' and 'code'. The body of an element is kept
+    # verbatim up to its end tag, so python and sql code may contain '<', '>' and '&'
+    # freely. Text, comments and declarations between elements are skipped.
+    def __init__(self):
+        self.elements = []
+        self.current = None
+        self.end_tag = None
+        self.buffer = ''
+        # Body of the current element read so far, without its unfinished tail
+        self.content = []
+
+    def feed(self, data):
+        self.buffer += data
+        while self.step():
+            pass
+
+    def step(self):
+        # Consumes one element or one piece of markup, False when more input is needed
+        if self.current is not None:
+            match = self.end_tag.search(self.buffer)
+            if match is None:
+                # Keep what may be the start of the end tag, the rest is body
+                tail = self.buffer.rfind('<')
+                if tail < 0 or not PARTIAL_END_TAG.fullmatch(self.buffer, tail):
+                    tail = len(self.buffer)
+                self.content.append(self.buffer[:tail])
+                self.buffer = self.buffer[tail:]
+                return False
+            self.content.append(self.buffer[:match.start()])
+            self.buffer = self.buffer[match.end():]
+            self.finish()
+            return True
+        start = self.buffer.find('<')
+        if start < 0:
+            self.buffer = ''
+            return False
+        self.buffer = self.buffer[start:]
+        for opening, closing in SKIPPED:
+            if self.buffer.startswith(opening):
+                end = self.buffer.find(closing, len(opening))
+                if end < 0:
+                    return False
+                self.buffer = self.buffer[end + len(closing):]
+                return True
+        match = START_TAG.match(self.buffer)
+        if match is None:
+            if PARTIAL_START_TAG.fullmatch(self.buffer):
+                return False
+            # A stray '<' outside of an element
+            self.buffer = self.buffer[1:]
+            return True
+        tag = match.group(1).lower()
+        self.current = raw_attributes(match.group(0))
+        self.current['type'] = tag
+        self.buffer = self.buffer[match.end():]
+        if match.group(2).rstrip().endswith('/'):
+            self.finish()
+        else:
+            # Everything up to the matching end tag is raw text
+            self.end_tag = re.compile(r'</%s\s*>' % re.escape(tag), re.IGNORECASE)
+        return True
+
+    def finish(self):
+        self.current['code'] = ''.join(self.content).strip()
+        self.elements.append(self.current)
+        self.current = None
+        self.end_tag = None
+        self.content = []
+
+
+def tokenize(chunks):
+    tokenizer = ElementTokenizer()
+    for chunk in chunks:
+        tokenizer.feed(chunk)
+    if tokenizer.current is not None:
+        raise Exception(f"Unclosed <{tokenizer.current['type']}> element")
+    return tokenizer.elements
+
+
+def render(xml_string, variables):
+    # Jinja yields the rendered file piece by piece, the tokenizer consumes it as it comes
+    return tokenize(Template(xml_string).generate(dict(RUNTIME_VARIABLES, **variables)))
+
+
+def file_state(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Plan:
+    # Immutable parse of one pipeline file, together with the state of the files it
+    # was compiled from so a stale plan can be detected without reparsing
+    __slots__ = ('path', 'elements', 'sources', 'digest')
+
+    def __init__(self, path, elements, sources):
+        object.__setattr__(self, 'path', path)
+        object.__setattr__(self, 'elements', tuple(types.MappingProxyType(dict(e)) for e in elements))
+        # ((path, mtime_ns, size, sha256), ...)
+        object.__setattr__(self, 'sources', tuple(tuple(s) for s in sources))
+        object.__setattr__(self, 'digest', hashlib.sha256(
+            ''.join(source[3] for source in self.sources).encode('utf-8')).hexdigest())
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Plan is immutable")
+
+    def status(self):
+        # 'fresh' when no source was touched, 'touched' when only timestamps moved
+        # and 'changed' when a source's content differs from what was compiled
+        status = 'fresh'
+        for path, mtime_ns, size, sha256 in self.sources:
+            try:
+                if file_state(path) == (mtime_ns, size):
+                    continue
+                if file_hash(path) != sha256:
+                    return 'changed'
+            except FileNotFoundError:
+                return 'changed'
+            status = 'touched'
+        return status
+
+    def restamped(self):
+        return Plan(self.path, self.elements,
+            [(path, *file_state(path), sha256) for path, _, _, sha256 in self.sources])
+
+    def to_json(self):
+        return {'format': PLAN_FORMAT, 'path': self.path, 'elements': [dict(e) for e in self.elements],
+            'sources': [list(s) for s in self.sources]}
+
+    @classmethod
+    def from_json(cls, data):
+        if data.get('format') != PLAN_FORMAT:
+            return None
+        return cls(data['path'], data['elements'], data['sources'])
+
+
+def compile_plan(path, variables_path=VARIABLES_FILE):
+    # Stat before reading, a file edited while we compile then looks stale next time
+    sources = []
+    contents = {}
+    for source in (path, variables_path):
+        state = file_state(source)
+        with open(source, 'rb') as f:
+            contents[source] = f.read()
+        sources.append((os.path.abspath(source), *state, hashlib.sha256(contents[source]).hexdigest()))
+    variables = json.loads(contents[variables_path])
+    elements = render(contents[path].decode('utf-8'), variables)
+    return Plan(os.path.abspath(path), elements, sources)
+
+
+def plan_path(key, directory=None):
+    directory = directory if directory else os.path.join(CACHE_DIR, 'plans')
+    name = hashlib.sha256('\0'.join(key).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(directory, f"{name}.json")
+
+
+def read_plan(file_path):
+    try:
+        with open(file_path) as f:
+            return Plan.from_json(json.load(f))
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_plan(file_path, plan):
+    # Rendered plans contain connection credentials, keep them private to the user
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(plan.to_json(), f)
+    os.replace(temp_path, file_path)
+
+
+def load_plan(path, variables_path=VARIABLES_FILE):
+    # Plan of a pipeline file: from this process' memory, from the on-disk cache, or
+    # compiled from source, in that order. Edited sources are picked up on the next call.
+    key = (os.path.abspath(path), os.path.abspath(variables_path))
+    with _plans_lock:
+        plan = _plans.get(key)
+    if plan is not None and plan.status() == 'fresh':
+        return plan
+
+    file_path = plan_path(key)
+    if plan is None:
+        plan = read_plan(file_path)
+        if plan is not None and [source[0] for source in plan.sources] != list(key):
+            plan = None
+    status = plan.status() if plan is not None else 'changed'
+    if status == 'changed':
+        plan = compile_plan(path, variables_path)
+    elif status == 'touched':
+        # Same content under a new timestamp, no need to parse again
+        plan = plan.restamped()
+    if status != 'fresh':
+        try:
+            write_plan(file_path, plan)
+        except OSError:
+            # A read-only checkout still works, it just compiles every time
+            pass
+    with _plans_lock:
+        _plans[key] = plan
+    return plan
@@ -0,0 +1,92 @@
+import threading
+from core.SharedFrame import new_run_id, to_transport, cleanup_run
+
+# Default memory budget for DataFrames kept between nodes of one run
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024
+
+
+def frame_size(df):
+    try:
+        return int(df.memory_usage(deep=True).sum())
+    except Exception:
+        return 0
+
+
+class ResultStore:
+    # Run-scoped hand-off of python node outputs to downstream python nodes.
+    # Entries live only while a downstream consumer still needs them; anything
+    # that is evicted or does not fit is simply read back from the database.
+    def __init__(self, consumers, memory_budget=None, run_id=None):
+        self.remaining = dict(consumers)
+        self.memory_budget = int(memory_budget) if memory_budget else DEFAULT_MEMORY_BUDGET
+        # Shared memory segments created for this run are named after it
+        self.run_id = run_id if run_id else new_run_id()
+        self.frames = {}
+        self.payloads = {}
+        self.sizes = {}
+        self.used = 0
+        # Output version of every node built in this run, for the build cache
+        self.versions = {}
+        self.track_versions = False
+        # Row limit for every python input of a development run
+        self.sample = None
+        # WorkerPool options of the run's task, for the python components
+        self.worker_options = None
+        self.lock = threading.Lock()
+
+    def wants(self, table):
+        return self.remaining.get(table, 0) > 0
+
+    def put(self, table, df, payload=None):
+        size = frame_size(df)
+        with self.lock:
+            if not self.wants(table) or size > self.memory_budget:
+                return False
+            self.drop(table)
+            # Make room by evicting the oldest entries first
+            while self.used + size > self.memory_budget and len(self.frames) > 0:
+                self.drop(next(iter(self.frames)))
+            self.frames[table] = df
+            if payload is not None:
+                self.payloads[table] = payload
+            self.sizes[table] = size
+            self.used += size
+            return True
+
+    def get(self, table):
+        with self.lock:
+            return self.frames.get(table)
+
+    def payload(self, table):
+        # Transport form of a stored frame for a worker process. A frame that
+        # arrived through shared memory is forwarded as-is without another copy.
+        with self.lock:
+            df = self.frames.get(table)
+            if df is None:
+                return None
+            if table not in self.payloads:
+                self.payloads[table] = to_transport(df, self.run_id)
+            return self.payloads[table]
+
+    def consumed(self, table):
+        # Called once per downstream consumer when it finishes, successful or not
+        with self.lock:
+            if table in self.remaining:
+                self.remaining[table] -= 1
+                if self.remaining[table] <= 0:
+                    self.drop(table)
+
+    def drop(self, table):
+        if table in self.frames:
+            del self.frames[table]
+            self.payloads.pop(table, None)
+            self.used -= self.sizes.pop(table)
+
+    def clear(self):
+        with self.lock:
+            self.frames = {}
+            self.payloads = {}
+            self.sizes = {}
+            self.used = 0
+        # Segments live exactly as long as the run
+        cleanup_run(self.run_id)
@@ -0,0 +1,375 @@
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.triggers.cron import CronTrigger
+from core.BuildCache import CACHE_DIR
+from core.Pipeline import Pipeline, ThreadLogger
+from core.Workspace import Workspace, PIPELINES, pipeline_name
+
+SOCKET_PATH = os.path.join(CACHE_DIR, 'scheduler.sock')
+LOG_FILE = 'scheduler.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Nodes built at the same time over every running pipeline
+DEFAULT_WORKER_BUDGET = 16
+# Pipeline runs in progress at the same time
+DEFAULT_MAX_RUNS = 10
+# Seconds between checks of the pipeline files for edits
+RELOAD_INTERVAL = 5
+# A tick missed by less than this many seconds (e.g. while the process was busy) still runs
+MISFIRE_GRACE = 30
+
+
+def file_logger(name, path):
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.FileHandler(path) if path else logging.StreamHandler(sys.__stdout__)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+class ScheduledPipeline:
+    def __init__(self, path, pipeline):
+        self.path = path
+        self.name = pipeline_name(path)
+        self.pipeline = pipeline
+        # Same file as a pipeline run on its own writes to
+        self.logger = file_logger(f"pipeline.{self.name}", f"{self.name}.log")
+        self.running = 0
+        self.paused = False
+        self.jobs = []
+        self.last_status = None
+        self.last_started = None
+        self.last_finished = None
+
+    @property
+    def max_instances(self):
+        return max([task.max_instances for task in self.pipeline.tasks], default=1)
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    # One JSON request per connection, answered with one JSON line
+    def handle(self):
+        try:
+            reply = self.server.scheduler.control(json.loads(self.rfile.readline()))
+        except Exception as E:
+            reply = {'ok': False, 'error': str(E)}
+        self.wfile.write((json.dumps(reply, default=str) + '\n').encode('utf-8'))
+        self.wfile.flush()
+        if reply.get('drained'):
+            self.server.scheduler.stopped.set()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Scheduler:
+    # Runs the tasks of every pipeline file in one process, so they share the
+    # connection pools, the python worker pool and a single budget of build slots.
+    # A pipeline never runs more often at once than its max_instances, edited
+    # files are picked up while idle, and a local socket takes control commands.
+    def __init__(self, pattern=PIPELINES, max_workers=None, max_runs=None, socket_path=SOCKET_PATH, log_file=LOG_FILE,
+            reload_interval=RELOAD_INTERVAL):
+        self.pattern = pattern
+        self.slots = threading.BoundedSemaphore(int(max_workers) if max_workers else DEFAULT_WORKER_BUDGET)
+        self.max_runs = int(max_runs) if max_runs else DEFAULT_MAX_RUNS
+        self.socket_path = socket_path
+        self.reload_interval = reload_interval
+        self.logger = file_logger('scheduler', log_file)
+        self.lock = threading.Condition()
+        self.pipelines = {}
+        # Files that failed to load, with the state they failed in
+        self.broken = {}
+        # Tables written by components of more than one pipeline file, as last reported
+        self.duplicates = {}
+        self.draining = False
+        self.stopped = threading.Event()
+        self.scheduler = BackgroundScheduler(
+            executors={'default': ThreadPoolExecutor(self.max_runs)},
+            job_defaults={'coalesce': True, 'misfire_grace_time': MISFIRE_GRACE})
+        self.server = None
+
+    def log(self, message):
+        self.logger.info(message)
+
+    def refresh(self):
+        # Add new pipeline files, drop deleted ones and reload edited ones
+        paths = sorted(glob.glob(self.pattern))
+        names = {pipeline_name(path): path for path in paths}
+        for name in list(self.pipelines):
+            if name not in names:
+                with self.lock:
+                    entry = self.pipelines.pop(name)
+                self.unschedule(entry)
+                self.log(f"Removed {entry.path}")
+        for name, path in names.items():
+            entry = self.pipelines.get(name)
+            try:
+                if entry is None:
+                    state = os.stat(path).st_mtime_ns
+                    if self.broken.get(path) == state:
+                        continue
+                    entry = ScheduledPipeline(path, Pipeline(path))
+                    self.broken.pop(path, None)
+                    with self.lock:
+                        self.pipelines[name] = entry
+                    self.log(f"Loaded {path}")
+                else:
+                    with self.lock:
+                        # A running pipeline reloads itself at the start of its next run
+                        if entry.running > 0 or not entry.pipeline.reload():
+                            continue
+                    self.log(f"Reloaded {path}")
+            except Exception as E:
+                if entry is None:
+                    self.broken[path] = os.stat(path).st_mtime_ns
+                self.logger.error(f"Could not load {path}: {E}")
+                continue
+            try:
+                self.schedule(entry)
+            except Exception as E:
+                self.unschedule(entry)
+                self.logger.error(f"Could not schedule {path}: {E}")
+        self.check_writers()
+
+    def check_writers(self):
+        # Concurrent runs build such a table one at a time, but the components
+        # overwrite each other's results, which is rarely intended
+        duplicates = Workspace({entry.name: entry.pipeline for entry in self.entries()}).duplicates()
+        if duplicates != self.duplicates:
+            for target, keys in duplicates.items():
+                self.logger.warning(f"\"{target[3]}\".\"{target[4]}\" is written by {', '.join(keys)}")
+            self.duplicates = duplicates
+
+    def unschedule(self, entry):
+        for job_id in entry.jobs:
+            try:
+                self.scheduler.remove_job(job_id)
+            except Exception:
+                pass
+        entry.jobs = []
+
+    def schedule(self, entry):
+        self.unschedule(entry)
+        for task in entry.pipeline.tasks:
+            if not task.schedule:
+                continue
+            job = self.scheduler.add_job(self.run, CronTrigger.from_crontab(task.schedule), args=(entry.name, task.id),
+                id=f"{entry.name}:{task.id}", max_instances=entry.max_instances, replace_existing=True)
+            entry.jobs.append(job.id)
+            if entry.paused or self.draining:
+                job.pause()
+
+    def run(self, name, task_id=None):
+        with self.lock:
+            entry = self.pipelines.get(name)
+            if entry is None or self.draining:
+                return
+            if entry.running >= entry.max_instances:
+                entry.logger.info(f"Skipped a run of {name}, {entry.running} still running")
+                return
+            entry.running += 1
+            entry.last_started = datetime.datetime.now()
+        status = 'failed'
+        try:
+            entry.pipeline.run(task=task_id, logger=entry.logger, slots=self.slots)
+            status = 'success'
+        except Exception:
+            entry.logger.error(f"Run of {name} failed:\n{traceback.format_exc()}")
+        finally:
+            ThreadLogger.bind(None)
+            with self.lock:
+                entry.running -= 1
+                entry.last_status = status
+                entry.last_finished = datetime.datetime.now()
+                self.lock.notify_all()
+
+    def entries(self, name=None):
+        with self.lock:
+            if name is None:
+                return list(self.pipelines.values())
+            if name not in self.pipelines:
+                raise Exception(f"Unknown pipeline '{name}'")
+            return [self.pipelines[name]]
+
+    def trigger(self, name, task=None):
+        entry = self.entries(name)[0]
+        with self.lock:
+            if self.draining:
+                raise Exception("The scheduler is draining")
+            if entry.running >= entry.max_instances:
+                raise Exception(f"'{name}' is already running")
+        self.scheduler.add_job(self.run, args=(name, task))
+        return {'ok': True, 'triggered': name}
+
+    def pause(self, name=None):
+        entries = self.entries(name)
+        for entry in entries:
+            entry.paused = True
+            for job_id in entry.jobs:
+                self.scheduler.pause_job(job_id)
+        return {'ok': True, 'paused': [entry.name for entry in entries]}
+
+    def resume(self, name=None):
+        entries = self.entries(name)
+        for entry in entries:
+            entry.paused = False
+            if not self.draining:
+                for job_id in entry.jobs:
+                    self.scheduler.resume_job(job_id)
+        return {'ok': True, 'resumed': [entry.name for entry in entries]}
+
+    def drain(self):
+        # No new runs from here on, returns once the running ones have finished
+        with self.lock:
+            self.draining = True
+        for entry in self.entries():
+            for job_id in entry.jobs:
+                self.scheduler.pause_job(job_id)
+        self.log("Draining, waiting for running pipelines to finish")
+        with self.lock:
+            while any(entry.running > 0 for entry in self.pipelines.values()):
+                self.lock.wait()
+        self.log("Drained")
+        return {'ok': True, 'drained': True}
+
+    def status(self):
+        pipelines = {}
+        for entry in self.entries():
+            next_runs = [job.next_run_time for job in (self.scheduler.get_job(job_id) for job_id in entry.jobs)
+                if job is not None and job.next_run_time is not None]
+            pipelines[entry.name] = {
+                'path': entry.path,
+                'running': entry.running,
+                'max_instances': entry.max_instances,
+                'paused': entry.paused,
+                'next_run': min(next_runs) if next_runs else None,
+                'last_status': entry.last_status,
+                'last_started': entry.last_started,
+                'last_finished': entry.last_finished,
+            }
+        return {'ok': True, 'pid': os.getpid(), 'draining': self.draining, 'pipelines': pipelines}
+
+    def control(self, request):
+        command = request.get('command')
+        if command == 'status':
+            return self.status()
+        if command == 'trigger':
+            return self.trigger(request.get('pipeline'), request.get('task'))
+        if command == 'pause':
+            return self.pause(request.get('pipeline'))
+        if command == 'resume':
+            return self.resume(request.get('pipeline'))
+        if command == 'reload':
+            self.refresh()
+            return self.status()
+        if command == 'drain':
+            return self.drain()
+        raise Exception(f"Unknown command '{command}'")
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            try:
+                send('status', socket_path=self.socket_path, timeout=5)
+                raise Exception(f"A scheduler is already listening on {self.socket_path}")
+            except (ConnectionError, FileNotFoundError, socket.timeout):
+                # Left behind by a scheduler that did not shut down cleanly
+                os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path) or '.', exist_ok=True)
+        self.server = ControlServer(self.socket_path, ControlHandler)
+        self.server.scheduler = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def serve(self):
+        if self.socket_path:
+            self.listen()
+        # Runs write to their own pipeline's log, anything else goes to the scheduler's
+        sys.stdout = ThreadLogger(self.logger, logging.INFO)
+        sys.stderr = ThreadLogger(self.logger, logging.ERROR)
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *_: self.stopped.set())
+        self.refresh()
+        self.scheduler.start()
+        self.log(f"Scheduler started with {len(self.pipelines)} pipelines")
+        try:
+            while not self.stopped.wait(self.reload_interval):
+                self.refresh()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self.log("Stopping, waiting for running pipelines to finish")
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            try:
+                os.remove(self.socket_path)
+            except FileNotFoundError:
+                pass
+        self.scheduler.shutdown(wait=True)
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        self.log("Scheduler stopped")
+
+
+def send(command, pipeline=None, socket_path=SOCKET_PATH, timeout=None, **options):
+    # Client side of the control socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        client.sendall((json.dumps(dict(options, command=command, pipeline=pipeline)) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run and control the pipeline scheduler')
+    parser.add_argument('--socket', default=SOCKET_PATH)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help='run every pipeline file on its schedule')
+    serve.add_argument('--pipelines', default=PIPELINES, help='glob of the pipeline files')
+    serve.add_argument('--max-workers', type=int, default=None, help='nodes built at once over all pipelines')
+    serve.add_argument('--max-runs', type=int, default=None, help='pipeline runs in progress at once')
+    serve.add_argument('--log', default=LOG_FILE)
+    commands.add_parser('status')
+    for command in ('trigger', 'pause', 'resume'):
+        commands.add_parser(command).add_argument('pipeline', nargs='?' if command != 'trigger' else None)
+    commands.add_parser('reload')
+    commands.add_parser('drain', help='stop starting runs, wait for running ones and exit')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        Scheduler(args.pipelines, args.max_workers, args.max_runs, args.socket, args.log).serve()
+        return
+    try:
+        reply = send(args.command, getattr(args, 'pipeline', None), socket_path=args.socket)
+    except (ConnectionError, FileNotFoundError):
+        print(f"No scheduler is listening on {args.socket}")
+        sys.exit(1)
+    print(json.dumps(reply, indent=4, default=str))
+    if not reply.get('ok'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
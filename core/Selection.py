@@ -0,0 +1,103 @@
+import re
+from core.Executor import downstream_map
+
+# node, +node (with its ancestors), node+ (with its descendants), +node+, tag:name
+SELECTOR = re.compile(r'^(\+?)([^+]+?)(\+?)$')
+
+
+def parse_selection(expression):
+    # Selectors are separated by spaces or commas, the result is their union
+    if isinstance(expression, (list, tuple, set)):
+        expression = ','.join(expression)
+    selectors = []
+    for token in re.split(r'[\s,]+', expression or ''):
+        if not token:
+            continue
+        match = SELECTOR.match(token)
+        if match is None:
+            raise Exception(f"Invalid selector '{token}'")
+        selectors.append((match.group(2), match.group(1) == '+', match.group(3) == '+'))
+    return selectors
+
+
+def closure(tables, edges):
+    # tables plus everything reachable from them over edges
+    found = set(tables)
+    stack = list(tables)
+    while stack:
+        for table in edges[stack.pop()]:
+            if table not in found:
+                found.add(table)
+                stack.append(table)
+    return found
+
+
+def matching(pipeline, name):
+    # Components a selector name refers to: an id, '<pipeline id>.<id>' or a
+    # whole referenced pipeline, or every component tagged 'tag:<name>'
+    if name.startswith('tag:'):
+        tag = name[len('tag:'):]
+        return [table for table in pipeline.all_tables() if tag in table.tags]
+    return [table for table in pipeline.tables if table.id == name] + pipeline.references.get(name, [])
+
+
+def materialized(tables):
+    # Tables that already exist in their database, with one query per connection
+    by_connection = {}
+    for table in tables:
+        if table.target() is not None:
+            by_connection.setdefault(table.connection, []).append(table)
+    found = set()
+    for connection, members in by_connection.items():
+        try:
+            status = connection.table_status([(i.schema, i.table) for i in members])
+        finally:
+            connection.close()
+        found.update(i for i in members if status[(i.schema, i.table)] is not None)
+    return found
+
+
+def select_tables(pipeline, select=None, exclude=None, defer=False):
+    # The components a run builds: the selection and everything it reads from, so
+    # the inputs are up to date (the build cache skips the unchanged ones). With
+    # defer, inputs that already have a table are read as they are, only the ones
+    # that have none yet (or only exist in memory) are built, with what they need.
+    graph = pipeline.graph
+    downstream = downstream_map(graph)
+    selected = set()
+    selectors = parse_selection(select) if select else [(None, False, False)]
+    for name, ancestors, descendants in selectors:
+        if name is None:
+            tables = list(graph)
+        else:
+            tables = matching(pipeline, name)
+            if len(tables) == 0:
+                raise Exception(f"No component matches '{name}' in {pipeline.file_name}")
+        selected.update(tables)
+        if ancestors:
+            selected.update(closure(tables, graph))
+        if descendants:
+            selected.update(closure(tables, downstream))
+    if not defer:
+        selected = closure(selected, graph)
+    for name, ancestors, descendants in parse_selection(exclude):
+        tables = matching(pipeline, name)
+        selected.difference_update(tables)
+        if ancestors:
+            selected.difference_update(closure(tables, graph))
+        if descendants:
+            selected.difference_update(closure(tables, downstream))
+
+    # Ephemeral inputs are inlined into their consumers' queries, they always come along
+    frontier = selected
+    while frontier:
+        frontier = set(i for table in frontier for i in graph[table] if i.materialization == 'ephemeral') - selected
+        selected.update(frontier)
+    if defer:
+        frontier = set(selected)
+        while frontier:
+            upstream = set(i for table in frontier for i in graph[table]) - selected
+            missing = upstream - materialized(upstream)
+            selected.update(missing)
+            frontier = missing
+    return selected
@@ -0,0 +1,170 @@
+import mmap
+import os
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory, resource_tracker
+
+# Shared memory segments are named <prefix>_<run id>_<n> so a run can find and
+# remove every segment it produced, including those left by a crashed worker
+SEGMENT_PREFIX = 'pipeline'
+# Frames smaller than this are cheaper to pickle than to map
+SHARED_MIN_BYTES = 1024 * 1024
+SHM_DIR = '/dev/shm'
+
+# Segments this process has open, kept alive while frames point into them
+_handles = {}
+_handles_lock = threading.Lock()
+
+
+def new_run_id():
+    return uuid.uuid4().hex[:12]
+
+
+def untrack(shm):
+    # The creating process does not own the segment, the run does. Without this
+    # the resource tracker unlinks it (and warns) when the worker exits.
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def shareable(series):
+    return isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biufcmM'
+
+
+def export_frame(df, run_id):
+    # Copy fixed-width columns into shared memory once, other columns are pickled.
+    # Returns a small picklable descriptor the receiving process maps back.
+    columns = []
+    segments = []
+    for position in range(df.shape[1]):
+        series = df.iloc[:, position]
+        name = df.columns[position]
+        if not shareable(series):
+            # Strings, objects and extension types travel with the descriptor itself
+            columns.append({'name': name, 'values': series.array})
+            continue
+        values = series.to_numpy()
+        segment = f"{SEGMENT_PREFIX}_{run_id}_{uuid.uuid4().hex[:12]}"
+        shm = shared_memory.SharedMemory(name=segment, create=True, size=max(values.nbytes, 1))
+        untrack(shm)
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+        shm.close()
+        segments.append(segment)
+        columns.append({'name': name, 'segment': segment, 'dtype': values.dtype.str, 'length': len(values)})
+
+    if isinstance(df.index, pd.RangeIndex):
+        index = ('range', df.index.start, df.index.stop, df.index.step, df.index.name)
+    else:
+        index = ('values', df.index)
+    return {'run_id': run_id, 'columns': columns, 'index': index, 'segments': segments}
+
+
+def attach(segment):
+    with _handles_lock:
+        shm = _handles.get(segment)
+        if shm is None:
+            shm = shared_memory.SharedMemory(name=segment)
+            untrack(shm)
+            _handles[segment] = shm
+        return shm
+
+
+def private_view(segment, dtype, length):
+    # Copy-on-write mapping of a segment: pages are shared until the array is written
+    # to, then copied for this process only. Without /dev/shm the values are copied.
+    path = os.path.join(SHM_DIR, segment)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        return np.ndarray((length,), dtype=dtype, buffer=buffer)
+    return np.array(np.ndarray((length,), dtype=dtype, buffer=attach(segment).buf))
+
+
+def import_frame(descriptor, writable=False):
+    # Rebuild the DataFrame on top of the shared buffers without copying them.
+    # Read-only unless writable, in which case writes stay private to this process.
+    data = {}
+    for column in descriptor['columns']:
+        if 'segment' in column and writable:
+            values = private_view(column['segment'], np.dtype(column['dtype']), column['length'])
+        elif 'segment' in column:
+            shm = attach(column['segment'])
+            values = np.ndarray((column['length'],), dtype=np.dtype(column['dtype']), buffer=shm.buf)
+            values.flags.writeable = False
+        else:
+            values = column['values']
+        data[column['name']] = values
+
+    kind = descriptor['index'][0]
+    if kind == 'range':
+        _, start, stop, step, name = descriptor['index']
+        index = pd.RangeIndex(start, stop, step, name=name)
+    else:
+        index = descriptor['index'][1]
+    if len(data) < len(descriptor['columns']):
+        # Duplicate column names, fall back to positional assembly
+        return pd.concat([pd.Series(data[c['name']], index=index, name=c['name']) for c in descriptor['columns']], axis=1)
+    return pd.DataFrame(data, index=index, copy=False)
+
+
+def to_transport(df, run_id):
+    # Descriptor for a frame crossing a process boundary: shared memory when it
+    # is large enough to be worth it, a plain pickle otherwise
+    if run_id is None or int(df.memory_usage(deep=False).sum()) < SHARED_MIN_BYTES:
+        return {'pickled': df}
+    return {'shared': export_frame(df, run_id)}
+
+
+def from_transport(payload, writable=False):
+    if payload is None:
+        return None
+    if 'pickled' in payload:
+        return payload['pickled']
+    return import_frame(payload['shared'], writable)
+
+
+def release(segments):
+    # Close this process' handles, tolerating frames that still reference them
+    with _handles_lock:
+        for segment in segments:
+            shm = _handles.pop(segment, None)
+            if shm is None:
+                continue
+            try:
+                shm.close()
+            except BufferError:
+                _handles[segment] = shm
+
+
+def discard(payload):
+    # Unlink the segments of one transported frame as soon as it has been used,
+    # instead of at the end of the run
+    if payload is not None and 'shared' in payload:
+        unlink(payload['shared']['segments'])
+
+
+def cleanup_run(run_id, segments=()):
+    # Unlink every segment of the run: the ones we know about and, on Linux, any
+    # others a worker created before crashing
+    names = set(segments)
+    prefix = f"{SEGMENT_PREFIX}_{run_id}_"
+    if os.path.isdir(SHM_DIR):
+        names.update(name for name in os.listdir(SHM_DIR) if name.startswith(prefix))
+    with _handles_lock:
+        names.update(name for name in _handles if name.startswith(prefix))
+    unlink(names)
+
+
+def unlink(names):
+    release(names)
+    for name in names:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
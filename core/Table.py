@@ -1,6 +1,19 @@
+import ast
 import os
+import re
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import pandas
+from core.Connection import STREAM_CHUNK_ROWS, render_watermark
+from core.WorkerPool import WorkerPool, execute_job, select_frame, frame_chunks, frame_digest
+from core.SharedFrame import from_transport, to_transport, discard
+from core.BuildCache import digest
+from core.Http import HttpSource
+
+# Connections and compiled handlers reused by python nodes with runtime="inline"
+INLINE_CONNECTIONS = {}
+INLINE_COMPILED = {}
 
 def run_python_code(code_str, file_name):
     # Step 1: Save the Python code string to a file
@@ -33,8 +46,87 @@ def run_python_code(code_str, file_name):
 
 
 
+def split_outside(value,separator):
+    # Split on separators that are not inside parentheses or quotes
+    items=[]
+    depth=0
+    quote=None
+    current=''
+    for char in value:
+        if quote:
+            quote=None if char==quote else quote
+        elif char in ('"',"'"):
+            quote=char
+        else:
+            depth+=1 if char=='(' else -1 if char==')' else 0
+        if char==separator and depth==0 and quote is None:
+            items.append(current)
+            current=''
+        else:
+            current+=char
+    items.append(current)
+    return items
+
+def parse_column_types(value):
+    # "height:integer, weight:numeric(6,2)" -> {'height': 'integer', 'weight': 'numeric(6,2)'}
+    types={}
+    for item in split_outside(value,','):
+        if not item.strip():
+            continue
+        col,_,dtype=item.rpartition(':')
+        if not col.strip() or not dtype.strip():
+            raise Exception(f"Invalid column_types entry '{item.strip()}', expected column:type")
+        types[col.strip()]=dtype.strip()
+    return types
+
+def parse_input_options(value):
+    # "t1: id, name; t2: weight > 10" -> {'t1': 'id, name', 't2': 'weight > 10'}
+    options={}
+    for item in split_outside(value,';'):
+        if not item.strip():
+            continue
+        match=re.match(r'\s*([\w$.-]+)\s*:(?!:)(.*)$',item,re.DOTALL)
+        if not match or not match.group(2).strip():
+            raise Exception(f"Invalid input entry '{item.strip()}', expected input_id: value")
+        options[match.group(1)]=match.group(2).strip()
+    return options
+
+def handler_inputs(code):
+    # Literal INPUTS = {...} declared at the top level of a python component, read
+    # without running the code: {'t1': {'columns': [...], 'where': '...', 'limit': 100}}
+    try:
+        tree=ast.parse(code)
+    except SyntaxError:
+        return {}
+    for node in tree.body:
+        if isinstance(node,ast.Assign) and any(isinstance(t,ast.Name) and t.id=='INPUTS' for t in node.targets):
+            try:
+                declared=ast.literal_eval(node.value)
+            except ValueError:
+                raise Exception("INPUTS must be a literal dict of input options")
+            if not isinstance(declared,dict) or not all(isinstance(v,dict) for v in declared.values()):
+                raise Exception("INPUTS must map input ids to dicts of columns, where and limit")
+            return declared
+    return {}
+
+def quote_identifier(name):
+    return '"'+name.replace('"','""')+'"'
+
+def reference_pattern(schema,table):
+    # Matches "schema"."table" and, for lower case names, the unquoted schema.table form
+    def part(name):
+        quoted=re.escape(f'"{name}"')
+        if re.fullmatch(r'[a-z_][a-z0-9_$]*',name):
+            # Unquoted identifiers fold to lower case, quoted ones must match exactly
+            return f'(?:{quoted}|(?<![\\w"$])(?i:{re.escape(name)})(?![\\w"$]))'
+        return quoted
+    return re.compile(f'{part(schema)}\\s*\\.\\s*{part(table)}')
+
+def strip_statement(code):
+    return code.strip().rstrip(';').strip()
+
 class Table:
-    def __init__(self,id,table,schema,database,connection,materialization,primary_key,inputs,schema_change,code,type,handler=None,pipeline=None):
+    def __init__(self,id,table,schema,database,connection,materialization,primary_key,inputs,schema_change,code,type,handler=None,pipeline=None,chunksize=None,runtime=None,timeout=None,cache=None,column_types=None,watermark=None,write_parallelism=None,input_columns=None,input_filter=None,sample=None,mode=None,http=None,tags=None):
         self.id = id
         self.table = table
         self.schema = schema
@@ -43,36 +135,339 @@ class Table:
         self.materialization = materialization if materialization else None
         self.handler = handler
         self.primary_key = primary_key if primary_key else None
-        self.inputs = inputs if inputs else []
+        self.inputs = [i.strip() for i in inputs.split(',') if i.strip()] if isinstance(inputs, str) else (inputs if inputs else [])
         self.schema_change = schema_change
         self.code = code
         self.type = type
         self.pipeline=pipeline
+        self.chunksize = int(chunksize) if chunksize else None
+        self.runtime = runtime if runtime else 'worker'
+        self.timeout = float(timeout) if timeout else None
+        self.cache = cache if cache else 'auto'
+        # Postgres types that replace the ones inferred from a python component's DataFrame
+        self.column_types = parse_column_types(column_types) if isinstance(column_types, str) else (column_types if column_types else {})
+        # Column whose high-water mark limits an incremental load to new rows
+        self.watermark = watermark if watermark else None
+        # Connections a python component's output is written over at the same time
+        self.write_parallelism = int(write_parallelism) if write_parallelism else None
+        # Columns, filter and row limit per input of a python component, pushed into the query that reads it
+        self.input_options = self.parse_input_options(input_columns,input_filter)
+        # Development runs: read at most this many rows of every input
+        self.sample = int(sample) if sample else None
+        # 'map' runs a python handler once per chunk of its input, in parallel
+        self.mode = mode if mode else None
+        # Request settings of an http component, its body lists the columns to extract
+        self.http_options = dict(http) if http else {}
+        self.http = HttpSource(**self.http_options, timeout=timeout, fields=code) if type=='http' else None
+        # Groups a run can select by, e.g. tag:nightly
+        self.tags = [i.strip() for i in tags.split(',') if i.strip()] if isinstance(tags, str) else (list(tags) if tags else [])
         self.validate()
+    def parse_input_options(self,input_columns,input_filter):
+        options={}
+        if self.type=='python' and self.code:
+            for input_id,declared in handler_inputs(self.code).items():
+                unknown=set(declared)-{'columns','where','limit'}
+                if unknown:
+                    raise Exception(f"Unknown INPUTS option(s) for '{input_id}': {', '.join(sorted(unknown))}")
+                options[input_id]=dict(declared)
+        # The XML attributes win over the handler's declaration
+        for input_id,value in parse_input_options(input_columns or '').items():
+            options.setdefault(input_id,{})['columns']=[c.strip() for c in value.split(',') if c.strip()]
+        for input_id,value in parse_input_options(input_filter or '').items():
+            options.setdefault(input_id,{})['where']=value
+        return {input_id:{'columns':list(o.get('columns') or []) or None,'where':o.get('where') or None,
+            'limit':int(o['limit']) if o.get('limit') is not None else None} for input_id,o in options.items()}
+    def cacheable(self,graph):
+        # Nodes with side effects only, or whose inputs cannot all be versioned, always run
+        if self.materialization=="" or self.materialization==None or self.materialization=='temp':
+            return False
+        if self.cache=='false':
+            return False
+        if len(self.inputs)==0:
+            # Sources read the outside world, only skip them when asked to
+            return self.cache=='true'
+        declared=set(i.id for i in graph[self])
+        return all(i in declared or i in self.pipeline.references for i in self.inputs)
+    def target(self):
+        # The database table this component writes, None when it writes nothing
+        # or only to a table of its own session
+        if self.materialization in ("",None,'ephemeral','temp') or self.connection is None or not self.table:
+            return None
+        return (self.connection.host,str(self.connection.port),self.connection.database,self.schema,self.table)
+    def exists(self):
+        return self.connection.table_status([(self.schema,self.table)])[(self.schema,self.table)] is not None
+    def fingerprint(self,input_versions):
+        return digest({
+            'id':self.id,
+            'type':self.type,
+            'code':self.code,
+            'handler':self.handler,
+            'table':self.table,
+            'schema':self.schema,
+            'database':self.database,
+            'connection':[self.connection.id,self.connection.host,str(self.connection.port),self.connection.database] if self.connection else None,
+            'materialization':self.materialization,
+            'primary_key':self.primary_key,
+            'schema_change':self.schema_change,
+            'chunksize':self.chunksize,
+            'column_types':self.column_types,
+            'watermark':self.watermark,
+            'input_options':self.input_options,
+            'sample':self.sample,
+            'mode':self.mode,
+            'http':self.http_options,
+            'inputs':input_versions,
+        })
     def validate(self):
         if self.materialization=='incremental' and self.primary_key==None:
             raise Exception("Incremental materialization requires a valid primary_key argument")
-    def get_dataframe(self):
+        if self.materialization=='ephemeral' and self.type!='sql':
+            raise Exception("Ephemeral materialization is only supported for sql components")
+        if self.watermark and (self.materialization!='incremental' or self.type!='sql'):
+            raise Exception("A watermark requires an incremental sql component")
+        if (self.input_options or self.sample) and self.type!='python':
+            raise Exception("Input columns, filters and samples are only supported for python components")
+        if self.mode not in (None,'map'):
+            raise Exception(f"Unknown mode '{self.mode}', expected map")
+        if self.mode=='map' and (self.type!='python' or len(self.inputs)!=1 or self.runtime=='subprocess'):
+            raise Exception("mode=\"map\" requires a python component with exactly one input and the worker or inline runtime")
+        unknown=[i for i in self.input_options if i not in self.inputs]
+        if unknown:
+            raise Exception(f"Input options refer to tables that are not inputs of '{self.id}': {', '.join(unknown)}")
+    def ephemeral_chain(self,include_self=False):
+        # Ephemeral tables this table reads from, directly or through other ephemeral
+        # tables, ordered so every CTE only refers to the ones before it
+        graph=self.pipeline.graph
+        chain=[]
+        def visit(table):
+            for upstream in [i for i in self.pipeline.all_tables() if i in graph[table]]:
+                if upstream.materialization=='ephemeral' and upstream not in chain:
+                    visit(upstream)
+                    chain.append(upstream)
+        visit(self)
+        if include_self and self.materialization=='ephemeral':
+            chain.append(self)
+        return chain
+    def compiled_sql(self):
+        # The statement that actually runs: ephemeral inputs become CTEs of this query.
+        # For an ephemeral table it is the query its consumers read it through.
+        if self.materialization=='ephemeral':
+            chain=self.ephemeral_chain(include_self=True)
+            code=f'SELECT * FROM "{self.schema}"."{self.table}"'
+        else:
+            chain=self.ephemeral_chain()
+            code=self.code
+        if len(chain)==0:
+            return code
+        def inline(body):
+            for table in chain:
+                body=reference_pattern(table.schema,table.table).sub(f'"ephemeral__{table.id}"',body)
+            return body
+        ctes=',\n'.join(f'"ephemeral__{table.id}" AS (\n{inline(strip_statement(table.code))}\n)' for table in chain)
+        body=inline(strip_statement(code))
+        leading_with=re.match(r'\s*WITH\s+(RECURSIVE\s+)?',body,re.IGNORECASE)
+        if leading_with:
+            # Merge into the query's own WITH list, RECURSIVE has to stay right after WITH
+            return f"WITH {leading_with.group(1) or ''}{ctes},\n{body[leading_with.end():]}"
+        return f"WITH {ctes}\n{body}"
+    def source_query(self):
+        # What a consumer reads: the table itself, or the inlined query of an ephemeral table
+        if self.materialization=='ephemeral':
+            return render_watermark(self.compiled_sql(),None)
+        return f""" SELECT * FROM "{self.schema}"."{self.table}" """
+    def read_query(self,columns=None,where=None,limit=None):
+        # What a python consumer reads: only the columns and rows it asked for
+        if not columns and not where and limit is None:
+            return self.source_query()
+        source=f'"{self.schema}"."{self.table}"' if self.materialization!='ephemeral' else f"({self.source_query()}) AS input"
+        query=f"SELECT {', '.join(quote_identifier(c) for c in columns) if columns else '*'} FROM {source}"
+        if where:
+            query+=f" WHERE {where}"
+        if limit is not None:
+            query+=f" LIMIT {int(limit)}"
+        return query
+    def input_key(self,input_table):
+        # Name an input is listed under in inputs, '<pipeline id>.<id>' (or the
+        # pipeline id alone) for the tables of a referenced pipeline
+        if input_table.pipeline is self.pipeline:
+            return input_table.id
+        references=self.pipeline.references
+        return next((name for name in self.inputs if input_table in references.get(name,[])),input_table.id)
+    def read_options(self,input_table,store=None):
+        # Columns, filter and limit this component reads an input with
+        options=dict(self.input_options.get(self.input_key(input_table),{'columns':None,'where':None,'limit':None}))
+        samples=[n for n in (options['limit'],self.sample,store.sample if store is not None else None) if n is not None]
+        options['limit']=min(samples) if samples else None
+        return options
+    def get_dataframe(self,chunksize=None,columns=None,chunk_bytes=None,where=None,limit=None):
+        query=self.read_query(columns,where,limit)
+        if chunksize or chunk_bytes:
+            # Hand back an iterator of DataFrame chunks read through a server-side cursor
+            return self.connection.stream_query(query,
+                chunk_size=int(chunksize) if chunksize else STREAM_CHUNK_ROWS,
+                chunk_bytes=int(chunk_bytes) if chunk_bytes else None)
         self.connection.Session()
         try:
-            df=self.connection.query_to_df(f""" SELECT * FROM "{self.schema}"."{self.table}" """)
+            df=self.connection.query_to_df(query)
         except Exception as E:
             df=None
             print(str(E))
             pass
         self.connection.close()
         return df
-    def build(self):
+    def python_job(self,input_tables,store=None):
+        inputs=[]
+        for i in input_tables:
+            options=self.read_options(i,store)
+            frame=store.get(i) if store is not None else None
+            if frame is not None and options['where']:
+                if i.materialization=="" or i.materialization==None:
+                    raise Exception(f"Input '{i.id}' of '{self.id}' is not materialized, it cannot be filtered with SQL")
+                # Filters are SQL, the materialized table is read instead
+                frame=None
+            if frame is not None and self.runtime=='inline':
+                # Shallow copy so a handler adding columns does not leak into other consumers
+                frame=select_frame(frame,options['columns'],options['limit'])
+                inputs.append({'id':i.id,'frame':frame.copy(deep=False),'chunksize':self.chunksize})
+                continue
+            # Crosses into a worker process, large frames go through shared memory.
+            # An entry evicted since get() has no payload left and is read from the database.
+            transport=store.payload(i) if frame is not None else None
+            if transport is not None:
+                inputs.append({'id':i.id,'transport':transport,'chunksize':self.chunksize,
+                    'columns':options['columns'],'limit':options['limit']})
+            else:
+                inputs.append({'id':i.id,'connection':i.connection.config(),'schema':i.schema,'table':i.table,'chunksize':self.chunksize,
+                    'query':i.read_query(**options)})
+        job={
+            'id':self.id,
+            'code':self.code,
+            'handler':self.handler,
+            'inputs':inputs,
+            'output':None,
+            'return_result':store is not None and store.wants(self),
+            'run_id':store.run_id if store is not None else None,
+            'hash_result':store is not None and store.track_versions,
+        }
+        if self.materialization != "" and self.materialization != None:
+            job['output']={'connection':self.connection.config(),'table':self.table,'database':self.database,'schema':self.schema,
+                'materialization':self.materialization,'schema_change':self.schema_change,'primary_key':self.primary_key,
+                'column_types':self.column_types,'write_parallelism':self.write_parallelism}
+        return job
+    def build_http(self,store=None):
+        df=self.http.fetch(self.pipeline.http_cache())
+        print(f"Fetched {len(df)} rows for '{self.id}'")
+        if self.materialization!="" and self.materialization!=None:
+            self.connection.df_to_table(df, self.table, self.database, self.schema, self.materialization, schema_change_behavior=self.schema_change,
+                primary_key=self.primary_key, column_types=self.column_types, parallelism=self.write_parallelism)
+        if store is not None:
+            # Versioned by content like a python component, and handed to python consumers in memory
+            store.versions[self]=frame_digest(df)
+            store.put(self,df)
+    def worker_options(self,store=None):
+        # Python worker settings of the task the run uses, or of the file's first task
+        if store is not None and store.worker_options is not None:
+            return store.worker_options
+        return self.pipeline.worker_options()
+    def map_chunks(self,input_table,store=None):
+        # Chunks of the mapped input, from memory or streamed from the database
+        options=self.read_options(input_table,store)
+        chunk_rows=self.chunksize if self.chunksize else STREAM_CHUNK_ROWS
+        frame=store.get(input_table) if store is not None else None
+        if frame is not None and not options['where']:
+            return frame_chunks(select_frame(frame,options['columns'],options['limit']),chunk_rows)
+        return input_table.connection.stream_query(input_table.read_query(**options),chunk_size=chunk_rows)
+    def map_chunk(self,input_table,chunk,store=None):
+        # One handler call on one chunk, returns (result, version)
+        job=self.python_job([],store)
+        job['output']=None
+        job['return_result']=True
+        if self.runtime=='inline':
+            job['transport_result']=False
+            job['inputs']=[{'id':input_table.id,'frame':chunk,'chunksize':None}]
+            outcome=execute_job(job,INLINE_CONNECTIONS,INLINE_COMPILED)
+            return outcome['result'],outcome['version']
+        payload=to_transport(chunk,job['run_id'])
+        job['inputs']=[{'id':input_table.id,'transport':payload,'chunksize':None}]
+        try:
+            reply=WorkerPool.shared(**self.worker_options(store)).run(job,timeout=self.timeout)
+        finally:
+            discard(payload)
+        result=from_transport(reply['result'])
+        if reply['result'] is not None and 'shared' in reply['result']:
+            # Own the rows so the segment can go as soon as the result is written
+            result=result.copy()
+            discard(reply['result'])
+        return result,reply['version']
+    def build_map(self,input_table,store=None):
+        # mode="map": the handler runs once per chunk of its input, on every free
+        # worker at once. Results are written in input order as they arrive, and a
+        # new chunk is only read when a result has been taken, so memory stays at a
+        # few chunks however large the input is.
+        parallel=WorkerPool.shared(**self.worker_options(store)).size if self.runtime=='worker' else 1
+        versions=[]
+        kept=[]
+        keep=store is not None and store.wants(self)
+        def results(threads):
+            pending=deque()
+            for chunk in self.map_chunks(input_table,store):
+                pending.append(threads.submit(self.map_chunk,input_table,chunk,store))
+                if len(pending)>=parallel:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        def frames(threads):
+            for result,version in results(threads):
+                versions.append(version)
+                if keep:
+                    kept.append(result)
+                yield result
+        with ThreadPoolExecutor(max_workers=parallel) as threads:
+            if self.materialization!="" and self.materialization!=None:
+                self.connection.frames_to_table(frames(threads),self.table,self.database,self.schema,self.materialization,
+                    schema_change_behavior=self.schema_change,primary_key=self.primary_key,column_types=self.column_types)
+            else:
+                for _ in frames(threads):
+                    pass
+        if store is not None:
+            store.versions[self]=digest(versions) if None not in versions else None
+            if keep and len(kept)>0:
+                store.put(self,pandas.concat(kept,ignore_index=True))
+        return None
+    def missing_inputs(self,input_tables,store=None):
+        # One catalog lookup per connection, no rows are read from the inputs themselves
+        by_connection={}
+        for i in input_tables:
+            if store is not None and store.get(i) is not None:
+                continue
+            if i.materialization=='ephemeral':
+                # Never written, it is inlined into the query that reads it
+                continue
+            by_connection.setdefault(i.connection,[]).append(i)
+        missing=set()
+        for connection,tables in by_connection.items():
+            # Give back the pooled connection the lookup borrowed, unless this thread already held it
+            borrowed=connection.session is None
+            try:
+                status=connection.table_status([(i.schema,i.table) for i in tables])
+            finally:
+                if borrowed:
+                    connection.close()
+            missing.update(i.id for i in tables if status[(i.schema,i.table)] is None)
+        return [i.id for i in input_tables if i.id in missing]
+    def build(self,store=None):
         if self.materialization =="" or self.materialization==None:
             if self.type=='sql':
-                self.connection.query(self.code)
-                print(self.code)
-                return self.code
-        if self.materialization != "" and self.materialization != None and self.type!='python':
-            df=self.get_dataframe()
-        input_tables=[i for i in self.pipeline.tables if i.id in self.inputs]
+                code=render_watermark(self.compiled_sql(),None)
+                self.connection.query(code)
+                self.connection.commit()
+                # Free-form SQL may change any table, the catalog reads them again
+                self.connection.catalog.clear()
+                print(code)
+                return code
+        input_tables=self.pipeline.input_tables(self)
         try:
-            dne_inputs=[i.id for i in input_tables if type(i.get_dataframe()) == type(None)]
+            dne_inputs=self.missing_inputs(input_tables,store)
         except:
             input_tables=[]
             dne_inputs=[]
@@ -83,18 +478,44 @@ class Table:
         if self.materialization != "" and self.materialization != None and self.type!='python':
             self.connection.Session()
         if self.type=='python':
-            input_str = '\n'.join([f"""{i.id} = [i.get_dataframe() for i in p.tables if i.id == '{i.id}'][0]""" for i in input_tables])
+            # Script used by the 'subprocess' runtime
+            input_str = '\n'.join([f"""{i.id} = [i.get_dataframe(chunksize={self.chunksize}, **{self.read_options(i,store)!r}) for i in p.all_tables() if i.id == '{i.id}'][0]""" for i in input_tables])
             formatted_code = f"""from core import Pipeline\n\n{self.code}\n\np=Pipeline('{self.pipeline.file_name}')\n\n{input_str}\n\n{self.id} = {self.handler}({','.join([i.id for i in input_tables])})"""
             if self.materialization != "" and self.materialization != None:
-                formatted_code = formatted_code+f"""\n\ncurr_table=[i for i in p.tables if i.id=='{self.id}'][0]\n """ +f"""\n\n\n[i.connection for i in p.tables if i.id == '{self.id}'][0].Session()\n\ncurr_table.connection.df_to_table({self.id}, curr_table.table, curr_table.database, curr_table.schema, curr_table.materialization, schema_change_behavior=curr_table.schema_change, primary_key=curr_table.primary_key)"""
-            r=run_python_code(formatted_code, f"compute__{self.id}.py")
-            print(r)
-            return r
+                formatted_code = formatted_code+f"""\n\ncurr_table=[i for i in p.tables if i.id=='{self.id}'][0]\n """ +f"""\n\n\n[i.connection for i in p.tables if i.id == '{self.id}'][0].Session()\n\ncurr_table.connection.df_to_table({self.id}, curr_table.table, curr_table.database, curr_table.schema, curr_table.materialization, schema_change_behavior=curr_table.schema_change, primary_key=curr_table.primary_key, column_types=curr_table.column_types, parallelism=curr_table.write_parallelism)"""
+            if self.mode=='map':
+                if len(input_tables)==0:
+                    raise Exception(f"Map component '{self.id}' has no input, '{self.inputs[0]}' does not exist or could not be looked up")
+                return self.build_map(input_tables[0],store)
+            if self.runtime=='subprocess':
+                r=run_python_code(formatted_code, f"compute__{self.id}.py")
+                print(r)
+                return r
+            job=self.python_job(input_tables,store)
+            if self.runtime=='inline':
+                # Same process as the executor, stored inputs are passed by reference
+                job['transport_result']=False
+                outcome=execute_job(job,INLINE_CONNECTIONS,INLINE_COMPILED)
+                if store is not None:
+                    store.versions[self]=outcome['version']
+                    if outcome['result'] is not None:
+                        store.put(self,outcome['result'])
+                return None
+            # Default runtime: hand the handler to an already warm worker process
+            reply=WorkerPool.shared(**self.worker_options(store)).run(job, timeout=self.timeout)
+            if store is not None:
+                store.versions[self]=reply['version']
+                if reply['result'] is not None:
+                    store.put(self,from_transport(reply['result']),payload=reply['result'])
+            return reply['log']
+
+        elif self.type=='http':
+            self.build_http(store)
 
         elif self.type=='sql':
-            query=self.code
+            query=self.compiled_sql()
             print(query)
-            self.connection.query_to_table(query, self.table, self.database, self.schema, self.materialization, schema_change_behavior=self.schema_change, primary_key=self.primary_key)
+            self.connection.query_to_table(query, self.table, self.database, self.schema, self.materialization, schema_change_behavior=self.schema_change, primary_key=self.primary_key, watermark=self.watermark)
             
             
             
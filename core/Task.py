@@ -1,10 +1,5 @@
-from apscheduler.schedulers.blocking import BlockingScheduler
-from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
-
-
 class Task:
-    def __init__(self,id,schedule,active=None,steps=None,force_build=None,code=None,type=None,pipeline=None):
+    def __init__(self,id,schedule,active=None,steps=None,force_build=None,code=None,type=None,pipeline=None,max_workers=None,python_workers=None,worker_max_tasks=None,worker_max_memory=None,result_memory=None,commit=None,http_cache_size=None,max_instances=None):
         self.id = id
         self.schedule = schedule if schedule else ""
         self.active = True if active=='true' else False
@@ -12,16 +7,19 @@ class Task:
         self.force_build = True if force_build=='true' else False
         self.type = type
         self.pipeline=pipeline
+        self.max_workers = int(max_workers) if max_workers else None
+        self.python_workers = int(python_workers) if python_workers else None
+        self.worker_max_tasks = int(worker_max_tasks) if worker_max_tasks else None
+        # Megabytes of resident memory after which a python worker is replaced
+        self.worker_max_memory = int(worker_max_memory) if worker_max_memory else None
+        # Megabytes of node outputs kept in memory for downstream python nodes during a run
+        self.result_memory = int(result_memory) if result_memory else None
+        # node, level or run: how much sql work is committed in one transaction
+        self.commit = commit if commit else 'node'
+        # Megabytes of http responses kept in the on-disk response cache
+        self.http_cache_size = int(http_cache_size) if http_cache_size else None
+        # Runs of the pipeline allowed at the same time, a tick that finds them all busy is skipped
+        self.max_instances = int(max_instances) if max_instances else 1
     def start(self):
-        scheduler = BlockingScheduler()
-        print(f"Starting Task {self.id}\nSchedule: {self.schedule}")
-        print(CronTrigger.from_crontab(self.schedule))
-        scheduler.add_job(self.pipeline.run, CronTrigger.from_crontab(self.schedule))
-        scheduler.start()
-        # next_run_time=scheduler.next_run_time
-        # print(f"Next Scheduled Run At: {next_run_time}")
-        # while True:
-        #     if scheduler.next_run_time !=next_run_time:
-        #         next_run_time=scheduler.next_run_time
-        #         print(f"Next Scheduled Run At: {next_run_time}")
-        #     pass
+        # Every task of the pipeline is scheduled together, in one process
+        return self.pipeline.start()
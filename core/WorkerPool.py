@@ -0,0 +1,338 @@
+import atexit
+import contextlib
+import io
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Connection as PipeConnection
+from core.SharedFrame import from_transport, to_transport, release
+from core.HttpCache import track
+
+# Modules every worker imports once at start up instead of once per python component
+PRELOAD_MODULES = ['pandas', 'psycopg2', 'core']
+
+
+def worker_main(channel, preload):
+    import importlib
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    channel.send(('ready', os.getpid()))
+
+    connections = {}
+    compiled = {}
+    while True:
+        try:
+            job = channel.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+                outcome = execute_job(job, connections, compiled)
+            reply = ('ok', dict(outcome, log=log.getvalue()))
+        except Exception:
+            reply = ('error', {'log': log.getvalue(), 'error': traceback.format_exc()})
+            # The failed job's DDL was rolled back, read the catalogs again
+            for connection in connections.values():
+                connection.catalog.clear()
+        finally:
+            # Let go of the input segments, the run unlinks them when it ends
+            release([segment for spec in job['inputs'] if spec.get('transport') and 'shared' in spec['transport']
+                for segment in spec['transport']['shared']['segments']])
+            job = None
+        # ru_maxrss is reported in kilobytes on Linux
+        reply[1]['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        channel.send(reply)
+
+
+def worker_connection(config, connections, run_id=None):
+    # Keep one Connection per target so the worker's pool stays warm between jobs
+    from core.Connection import Connection
+    key = tuple(sorted((k, str(v)) for k, v in config.items()))
+    if key not in connections:
+        connections[key] = Connection(**config)
+    # Catalog entries are reused by the jobs of one run only
+    connections[key].catalog.switch(run_id)
+    return connections[key]
+
+
+def execute_job(job, connections, compiled):
+    code_key = (job['id'], job['code'])
+    if code_key not in compiled:
+        compiled[code_key] = compile(job['code'], f"compute__{job['id']}.py", 'exec')
+    namespace = {'__name__': f"compute__{job['id']}"}
+    # CachedSessions the handler creates report into the job's stats
+    with track() as http_stats:
+        exec(compiled[code_key], namespace)
+    handler = namespace[job['handler']]
+
+    inputs = []
+    for spec in job['inputs']:
+        if spec.get('transport') is not None:
+            # Handlers may edit their inputs in place like any DataFrame they read
+            spec['frame'] = select_frame(from_transport(spec['transport'], writable=True), spec.get('columns'), spec.get('limit')).copy(deep=False)
+        if spec.get('frame') is not None:
+            # Handed over from an upstream node of the same run, no database read
+            inputs.append(frame_chunks(spec['frame'], spec['chunksize']) if spec.get('chunksize') else spec['frame'])
+            continue
+        connection = worker_connection(spec['connection'], connections, job.get('run_id'))
+        # The query carries the consumer's columns, filter and limit, and inlines ephemeral inputs
+        query = spec.get('query') or f""" SELECT * FROM "{spec['schema']}"."{spec['table']}" """
+        if spec.get('chunksize'):
+            inputs.append(connection.stream_query(query, chunk_size=spec['chunksize']))
+        else:
+            connection.Session()
+            try:
+                inputs.append(connection.query_to_df(query))
+            finally:
+                connection.close()
+
+    with track(http_stats):
+        df = handler(*inputs)
+    if http_stats.requests > 0:
+        print(f"HTTP cache: {http_stats.summary()}")
+
+    output = job.get('output')
+    if output is not None:
+        connection = worker_connection(output['connection'], connections, job.get('run_id'))
+        connection.Session()
+        try:
+            connection.df_to_table(df, output['table'], output['database'], output['schema'], output['materialization'],
+                schema_change_behavior=output['schema_change'], primary_key=output['primary_key'],
+                column_types=output.get('column_types'), parallelism=output.get('write_parallelism'))
+        finally:
+            connection.close()
+    outcome = {'result': None, 'version': None}
+    if job.get('hash_result'):
+        outcome['version'] = frame_digest(df)
+    if job.get('return_result'):
+        outcome['result'] = to_transport(df, job.get('run_id')) if job.get('transport_result', True) else df
+    return outcome
+
+
+def frame_digest(df):
+    # Content hash of a handler's output, used as its version by the build cache
+    try:
+        import pandas as pd
+        import hashlib
+        values = pd.util.hash_pandas_object(df, index=True).values.tobytes()
+        header = repr([(str(c), str(t)) for c, t in df.dtypes.items()]).encode('utf-8')
+        return hashlib.sha256(header + values).hexdigest()
+    except Exception:
+        return None
+
+
+def select_frame(df, columns=None, limit=None):
+    # Projection and row limit of a frame handed over in memory
+    if columns:
+        df = df[list(columns)]
+    if limit is not None:
+        df = df.head(int(limit))
+    return df
+
+
+def frame_chunks(df, chunksize):
+    for start in range(0, max(len(df), 1), chunksize):
+        yield df.iloc[start:start + chunksize]
+
+
+class Channel:
+    # Duplex message channel over a pair of pipes
+    def __init__(self, reader, writer):
+        self.reader = PipeConnection(reader, writable=False)
+        self.writer = PipeConnection(writer, readable=False)
+        self.closed = False
+
+    def send(self, message):
+        self.writer.send(message)
+
+    def recv(self):
+        return self.reader.recv()
+
+    def poll(self, timeout=None):
+        return self.reader.poll(timeout)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.reader.close()
+            self.writer.close()
+
+
+def main():
+    # Entry point of a worker process, see Worker below
+    reader, writer = int(sys.argv[1]), int(sys.argv[2])
+    # Keep handler output off the protocol pipe
+    os.dup2(2, 1)
+    worker_main(Channel(reader, writer), sys.argv[3:])
+
+
+class Worker:
+    def __init__(self, preload):
+        parent_read, child_write = os.pipe()
+        child_read, parent_write = os.pipe()
+        # Started as a fresh interpreter rather than multiprocessing's spawn so the
+        # caller's __main__ script is never re-imported, and without the daemon flag
+        # because a handler may itself run a Pipeline that starts workers
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', 'from core.WorkerPool import main; main()', str(child_read), str(child_write)] + list(preload),
+            pass_fds=(child_read, child_write),
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p)),
+        )
+        os.close(child_read)
+        os.close(child_write)
+        self.channel = Channel(parent_read, parent_write)
+        self.ready = False
+        self.tasks = 0
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def wait_ready(self, timeout):
+        if not self.ready:
+            if not self.channel.poll(timeout):
+                raise Exception("Python worker did not start in time")
+            self.channel.recv()
+            self.ready = True
+
+    def stop(self, timeout=5):
+        try:
+            self.channel.send(None)
+        except (OSError, ValueError):
+            pass
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.channel.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.channel.close()
+
+
+class WorkerPool:
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, size=None, max_tasks=100, max_memory=None, start_timeout=120, preload=None):
+        self.size = int(size) if size else (os.cpu_count() or 2)
+        self.max_tasks = int(max_tasks) if max_tasks else None
+        self.max_memory = int(max_memory) if max_memory else None
+        self.start_timeout = start_timeout
+        self.preload = preload if preload is not None else PRELOAD_MODULES
+        self.lock = threading.Condition()
+        self.closed = False
+        self.idle = []
+        self.busy = 0
+        # Start every worker up front so imports happen before the first job arrives
+        for _ in range(self.size):
+            self.idle.append(Worker(self.preload))
+
+    @classmethod
+    def shared(cls, **options):
+        with cls._shared_lock:
+            if cls._shared is None or cls._shared.closed:
+                cls._shared = cls(**options)
+            return cls._shared
+
+    @classmethod
+    def close_shared(cls):
+        with cls._shared_lock:
+            pool = cls._shared
+            cls._shared = None
+        if pool is not None:
+            pool.close()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise Exception("Python worker pool is closed")
+                if len(self.idle) > 0:
+                    self.busy += 1
+                    return self.idle.pop()
+                if self.busy < self.size:
+                    self.busy += 1
+                    break
+                self.lock.wait()
+        try:
+            return Worker(self.preload)
+        except Exception:
+            with self.lock:
+                self.busy -= 1
+                self.lock.notify()
+            raise
+
+    def release(self, worker, retire=False):
+        with self.lock:
+            self.busy -= 1
+            if not retire and not self.closed:
+                self.idle.append(worker)
+                worker = None
+            self.lock.notify()
+        if worker is not None:
+            worker.stop()
+
+    def run(self, job, timeout=None):
+        worker = self.acquire()
+        try:
+            worker.wait_ready(self.start_timeout)
+            worker.channel.send(job)
+            started = time.monotonic()
+            if not worker.channel.poll(timeout):
+                # Released as a dead worker below
+                worker.kill()
+                raise Exception(f"Python component '{job['id']}' timed out after {time.monotonic() - started:.0f}s")
+            status, reply = worker.channel.recv()
+        except (EOFError, OSError) as E:
+            worker.kill()
+            self.release_dead(worker)
+            raise Exception(f"Python worker for '{job['id']}' exited unexpectedly: {E}")
+        except Exception:
+            if worker.is_alive() and not worker.channel.closed:
+                self.release(worker, retire=True)
+            else:
+                worker.kill()
+                self.release_dead(worker)
+            raise
+
+        worker.tasks += 1
+        # Recycle workers that have run too many jobs or grown too large
+        retire = (self.max_tasks is not None and worker.tasks >= self.max_tasks) or \
+            (self.max_memory is not None and reply['rss'] >= self.max_memory)
+        self.release(worker, retire=retire)
+
+        if reply['log']:
+            print(reply['log'])
+        if status == 'error':
+            raise Exception(f"Python component '{job['id']}' failed:\n{reply['error']}")
+        return reply
+
+    def release_dead(self, worker):
+        with self.lock:
+            self.busy -= 1
+            self.lock.notify()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle = self.idle
+            self.idle = []
+            self.lock.notify_all()
+        for worker in idle:
+            worker.stop()
+
+
+atexit.register(WorkerPool.close_shared)
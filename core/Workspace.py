@@ -0,0 +1,65 @@
+import glob
+import os
+from core.Pipeline import Pipeline
+
+PIPELINES = 'pipelines/*.xml'
+
+
+def pipeline_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def node_key(table):
+    # Component ids are only unique within their file, e.g. 'kanto:kanto_core'
+    return f"{pipeline_name(table.pipeline.file_name)}:{table.id}"
+
+
+class Workspace:
+    # Every pipeline file as one graph. Nodes are keyed by file and id, so a node
+    # that several pipelines run (through <pipeline ref>) is one node, and nodes
+    # of different files that write the same table can be told apart.
+    def __init__(self, pipelines):
+        # name -> Pipeline
+        self.pipelines = dict(pipelines)
+        # path -> error of the files that did not load
+        self.errors = {}
+        self.nodes = {}
+        self.graph = {}
+        for pipeline in self.pipelines.values():
+            for table, upstream in pipeline.graph.items():
+                key = node_key(table)
+                self.nodes.setdefault(key, table)
+                self.graph.setdefault(key, set()).update(node_key(i) for i in upstream)
+
+    @classmethod
+    def load(cls, pattern=PIPELINES):
+        # Files that do not load are reported in errors instead of failing the workspace
+        pipelines = {}
+        errors = {}
+        for path in sorted(glob.glob(pattern)):
+            try:
+                pipelines[pipeline_name(path)] = Pipeline(path)
+            except Exception as E:
+                errors[path] = str(E)
+        workspace = cls(pipelines)
+        workspace.errors = errors
+        return workspace
+
+    def writers(self):
+        # (host, port, database, schema, table) -> keys of the nodes writing it
+        writers = {}
+        for key, table in self.nodes.items():
+            target = table.target()
+            if target is not None:
+                writers.setdefault(target, []).append(key)
+        return writers
+
+    def duplicates(self):
+        return {target: keys for target, keys in self.writers().items() if len(keys) > 1}
+
+    def downstream(self):
+        downstream = {key: [] for key in self.graph}
+        for key, upstream in self.graph.items():
+            for input_key in sorted(upstream):
+                downstream[input_key].append(key)
+        return downstream
@@ -1,5 +1,15 @@
 from .Task import Task
+from .Catalog import Catalog
+from .ConnectionPool import ConnectionPool
 from .Connection import Connection
+from .HttpCache import HttpCache, CachedSession
+from .Http import HttpSource
 from .Table import Table
+from .WorkerPool import WorkerPool
+from .ResultStore import ResultStore
+from .BuildCache import BuildCache
+from .Executor import Executor
 from .Pipeline import Pipeline
 
+from .Scheduler import Scheduler
+from .Workspace import Workspace
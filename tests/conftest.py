@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+import threading
+import http.server
+import pytest
+
+# Run from the repository root: python -m pytest tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+NAMES = ['bulbasaur', 'ivysaur', 'venusaur', 'charmander', 'charmeleon']
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    # A small JSON API: a paginated list, one document per item, an endpoint that
+    # answers 503 a few times first, and ETags on everything
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('If-None-Match')))
+            failures = server.failures.get(self.path, 0)
+            if failures:
+                server.failures[self.path] = failures - 1
+        if failures:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        parts = self.path.strip('/').split('/')
+        if parts[0] == 'list':
+            page = int(parts[1])
+            start = page * 2
+            body = {'results': [{'name': name} for name in NAMES[start:start + 2]],
+                'next': f"{server.url}/list/{page + 1}" if start + 2 < len(NAMES) else None}
+        elif parts[0] == 'pokemon' and parts[1] in NAMES:
+            index = NAMES.index(parts[1])
+            body = {'name': parts[1], 'height': index + 1,
+                'stats': [{'stat': {'name': 'hp'}, 'base_stat': 40 + index}, {'stat': {'name': 'speed'}, 'base_stat': 50}]}
+        elif parts[0] == 'blob':
+            body = {'id': parts[1], 'data': 'x' * 400}
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = json.dumps(body).encode('utf-8')
+        etag = f'"{len(data)}-{parts[-1]}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.failures = {}
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def paths(server):
+    # Paths the stand-in server was asked for, in order
+    return [path for path, _ in server.requests]
@@ -0,0 +1,36 @@
+import pytest
+from conftest import NAMES, paths
+from core.Http import HttpSource
+
+
+def test_pagination_and_fields(server):
+    source = HttpSource(url=server.url + '/pokemon/{name}', list_url=server.url + '/list/0', list_path='results',
+        next_path='next', concurrency=3, response_cache='false',
+        fields='name: name\nheight: height\nhp: stats[stat.name=hp].base_stat\nstats: stats[*].stat.name | join(",")')
+    df = source.fetch()
+    assert [p for p in paths(server) if p.startswith('/list')] == ['/list/0', '/list/1', '/list/2']
+    # Rows come out in list order, whatever order the responses arrive in
+    assert list(df['name']) == NAMES
+    assert list(df['height']) == [1, 2, 3, 4, 5]
+    assert list(df['hp']) == [40, 41, 42, 43, 44]
+    assert set(df['stats']) == {'hp,speed'}
+
+
+def test_503_is_retried(server):
+    server.failures['/pokemon/ivysaur'] = 2
+    source = HttpSource(url=server.url + '/pokemon/ivysaur', backoff=0, response_cache='false', fields='name: name')
+    df = source.fetch()
+    assert list(df['name']) == ['ivysaur']
+    assert paths(server) == ['/pokemon/ivysaur'] * 3
+
+
+def test_503_after_the_last_retry(server):
+    server.failures['/pokemon/ivysaur'] = 5
+    source = HttpSource(url=server.url + '/pokemon/{name}', list_url=server.url + '/list/0', list_path='results',
+        next_path='next', retries=2, backoff=0, response_cache='false', fields='name: name')
+    with pytest.raises(Exception, match='status 503'):
+        source.fetch()
+    skipping = HttpSource(url=server.url + '/pokemon/{name}', list_url=server.url + '/list/0', list_path='results',
+        next_path='next', retries=2, backoff=0, on_error='skip', response_cache='false', fields='name: name')
+    server.failures['/pokemon/ivysaur'] = 5
+    assert list(skipping.fetch()['name']) == [name for name in NAMES if name != 'ivysaur']
@@ -0,0 +1,57 @@
+import os
+from conftest import NAMES, paths
+from core.Http import HttpSource
+from core.HttpCache import HttpCache, CachedSession, CacheStats
+
+
+def test_304_revalidation(server, tmp_path):
+    cache = HttpCache(str(tmp_path))
+    stats = CacheStats()
+    url = server.url + '/pokemon/venusaur'
+    with CachedSession(cache, stats=stats) as session:
+        first = session.get(url)
+        second = session.get(url)
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    # The second request carried the stored ETag and was answered with a 304
+    assert server.requests[0][1] is None
+    assert server.requests[1][1] == first.headers['ETag']
+    assert (stats.misses, stats.revalidated, stats.hits) == (1, 1, 0)
+
+
+def test_fresh_entries_skip_the_server(server, tmp_path):
+    cache = HttpCache(str(tmp_path))
+    stats = CacheStats()
+    with CachedSession(cache, ttl=60, stats=stats) as session:
+        session.get(server.url + '/pokemon/venusaur')
+        assert session.get(server.url + '/pokemon/venusaur').json()['name'] == 'venusaur'
+    assert len(server.requests) == 1
+    assert (stats.misses, stats.revalidated, stats.hits) == (1, 0, 1)
+
+
+def test_repeated_extraction_revalidates(server, tmp_path):
+    cache = HttpCache(str(tmp_path))
+    source = HttpSource(url=server.url + '/pokemon/{name}', list_url=server.url + '/list/0', list_path='results',
+        next_path='next', fields='name: name')
+    first = source.fetch(cache)
+    assert (source.stats.misses, source.stats.revalidated) == (len(NAMES) + 3, 0)
+    second = source.fetch(cache)
+    assert (source.stats.misses, source.stats.revalidated) == (0, len(NAMES) + 3)
+    assert list(second['name']) == list(first['name'])
+
+
+def test_least_recently_used_is_evicted(server, tmp_path):
+    # Room for two bodies of a little over 400 bytes
+    cache = HttpCache(str(tmp_path), max_size=1000 / 1024 / 1024)
+    with CachedSession(cache, ttl=60) as session:
+        session.get(server.url + '/blob/a')
+        session.get(server.url + '/blob/b')
+        # b was used more recently than a, until a is read again
+        os.utime(cache.paths(server.url + '/blob/a')[0], (100, 100))
+        os.utime(cache.paths(server.url + '/blob/b')[0], (200, 200))
+        session.get(server.url + '/blob/a')
+        session.get(server.url + '/blob/c')
+    assert cache.lookup(server.url + '/blob/a') is not None
+    assert cache.lookup(server.url + '/blob/b') is None
+    assert cache.lookup(server.url + '/blob/c') is not None
+    assert paths(server) == ['/blob/a', '/blob/b', '/blob/c']
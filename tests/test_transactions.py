@@ -0,0 +1,68 @@
+import os
+import json
+import logging
+import shutil
+import pytest
+import psycopg2
+from core import Pipeline
+
+# Needs a Postgres database: point PIPELINE_TEST_VARIABLES at a variables.json
+# with the connection_1_* entries of a database the test may write to.
+VARIABLES = os.environ.get('PIPELINE_TEST_VARIABLES')
+pytestmark = pytest.mark.skipif(not VARIABLES, reason='PIPELINE_TEST_VARIABLES is not set')
+
+PIPELINE = '''
+<connection id="c1" host="{{ connection_1_host }}" port="{{ connection_1_port }}" username="{{ connection_1_username }}" database="{{ connection_1_database }}" password="{{ connection_1_password }}"></connection>
+<task id="t" schedule="*/1 * * * *" commit="run"></task>
+<sql id="land" table="TX_LAND" schema="PIPELINE_TEST" database="x" connection="c1" materialization="truncate" inputs="" schema_change="drop_and_recreate" cache="false">
+SELECT g AS id, '%(tag)s' AS tag, clock_timestamp() AS ts FROM generate_series(1, 10) g
+</sql>
+<sql id="eph" table="TX_EPH" schema="PIPELINE_TEST" database="x" connection="c1" materialization="ephemeral" inputs="land">
+SELECT id, tag, ts FROM "PIPELINE_TEST"."TX_LAND"
+</sql>
+<sql id="wm" table="TX_WM" schema="PIPELINE_TEST" database="x" connection="c1" materialization="incremental" primary_key="id" watermark="ts" inputs="eph" schema_change="drop_and_recreate">
+SELECT id, tag, ts FROM "PIPELINE_TEST"."TX_EPH"
+</sql>
+<sql id="sw" table="TX_SW" schema="PIPELINE_TEST" database="x" connection="c1" materialization="swap" inputs="eph" schema_change="drop_and_recreate">
+SELECT id, tag FROM "PIPELINE_TEST"."TX_EPH"
+</sql>
+<sql id="last" table="TX_LAST" schema="PIPELINE_TEST" database="x" connection="c1" materialization="truncate" inputs="sw,wm" schema_change="drop_and_recreate">
+SELECT %(last)s AS n FROM "PIPELINE_TEST"."TX_SW"
+</sql>
+'''
+
+
+def run(tag, last):
+    with open('pipelines/tx.xml', 'w') as f:
+        f.write(PIPELINE % {'tag': tag, 'last': last})
+    Pipeline('pipelines/tx.xml').run(force_build=True, logger=logging.getLogger())
+
+
+def tags(variables):
+    conn = psycopg2.connect(host=variables['connection_1_host'], port=variables['connection_1_port'],
+        user=variables['connection_1_username'], password=variables['connection_1_password'],
+        dbname=variables['connection_1_database'])
+    try:
+        with conn.cursor() as cur:
+            found = {}
+            for table in ('TX_LAND', 'TX_WM', 'TX_SW'):
+                cur.execute(f'SELECT DISTINCT tag FROM "PIPELINE_TEST"."{table}"')
+                found[table] = sorted(i[0] for i in cur.fetchall())
+            return found
+    finally:
+        conn.close()
+
+
+def test_failing_node_rolls_back_the_whole_run(tmp_path, monkeypatch):
+    # The ephemeral node between land and its consumers must not commit land
+    # early, a failure at the end of the run leaves every table as it was.
+    shutil.copy(VARIABLES, tmp_path / 'variables.json')
+    with open(VARIABLES) as f:
+        variables = json.load(f)
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('pipelines')
+    run('first', 'count(*)')
+    assert tags(variables) == {'TX_LAND': ['first'], 'TX_WM': ['first'], 'TX_SW': ['first']}
+    with pytest.raises(Exception):
+        run('second', '1/0')
+    assert tags(variables) == {'TX_LAND': ['first'], 'TX_WM': ['first'], 'TX_SW': ['first']}